@@ -1,15 +1,43 @@
 from __future__ import annotations
 
-from decimal import Decimal
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timedelta, timezone
+import atexit
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import logging
+import math
+import mmap
+import multiprocessing
+import os
 import random
+import re
+import secrets
+import sqlite3
 import string
+import struct
+import threading
+import time
+import weakref
 
+import click
 from flask import (
-    Flask, render_template, request, redirect, url_for, flash, session, g, abort
+    Flask, render_template, request, redirect, url_for, flash, session, g, abort, Response,
+    before_render_template, template_rendered, has_request_context, stream_with_context,
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import event, func, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as OrmSession
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -17,13 +45,143 @@ app = Flask(__name__)
 app.secret_key = "food-aggregator-secret"
 app.url_map.strict_slashes = False
 
-# XAMPP MySQL default:
-app.config["SQLALCHEMY_DATABASE_URI"] = "mysql+pymysql://root:@127.0.0.1:3306/food_aggregator"
+# XAMPP MySQL default (DATABASE_URL overrides, e.g. for bench.py runs):
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "mysql+pymysql://root:@127.0.0.1:3306/food_aggregator"
+)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
+
+def engine_options(uri: str) -> dict:
+    """
+    Per-backend engine settings. The same models run on MySQL (XAMPP) and on
+    SQLite (a file, or "sqlite://" in-memory for tests and benchmarks).
+    """
+    if uri.startswith("sqlite"):
+        # Flask-SQLAlchemy already shares one connection (StaticPool) for in-memory URIs
+        return {"connect_args": {"check_same_thread": False, "timeout": 30}}
+    return {"pool_pre_ping": True, "pool_recycle": 280}
+
+
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+
+# Server-side carts: "sql" (shared by all workers) or "memory" (a per-process LRU,
+# only for a single-process server: with several gunicorn workers a cart would
+# vanish whenever a request lands on another worker)
+app.config["CART_BACKEND"] = "sql"
+app.config["CART_TTL_SECONDS"] = 2 * 60 * 60
+app.config["CART_MAX_ENTRIES"] = 50_000
+
+# Menu snapshots: with MENU_SHARED_DIR set, workers share version counters and
+# snapshot bytes through mmap'd files; otherwise each process keeps its own copy
+# and re-checks the database at least every MENU_SNAPSHOT_MAX_AGE seconds, so a
+# menu page may lag another worker's edit by that long. Checkout never does: it
+# compares the snapshot with restaurants.menu_version before pricing the cart.
+app.config["MENU_SHARED_DIR"] = None
+app.config["MENU_SNAPSHOT_MAX_AGE"] = 30
+
+# Per-request profiling (opt-in): Server-Timing headers, a "fa.perf" log line
+# per request and the /admin/perf report
+app.config["PROFILING"] = False
+app.config["PROFILING_SLOW_QUERIES"] = 5  # slowest statements kept per request
+app.config["PROFILING_N_PLUS_ONE"] = 5  # same statement this many times => N+1 suspect
+app.config["PROFILING_WINDOW"] = 2000  # samples per endpoint kept for percentiles
+
+# Prometheus metrics at /metrics. With METRICS_DIR set, each worker dumps its
+# totals there (at most every METRICS_FLUSH_SECONDS) and /metrics merges them.
+app.config["METRICS_DIR"] = None
+app.config["METRICS_FLUSH_SECONDS"] = 1.0
+
+# Background jobs: a persistent SQL queue drained by an in-process thread pool.
+# JOBS_AUTOSTART starts the pool on the first request (never for in-memory SQLite,
+# whose single shared connection cannot be used from two threads at once).
+app.config["JOBS_AUTOSTART"] = True
+app.config["JOBS_WORKERS"] = 2
+app.config["JOBS_POLL_SECONDS"] = 0.5
+app.config["JOBS_LOCK_TIMEOUT"] = 5 * 60  # a "running" job older than this is requeued
+app.config["JOBS_RETENTION_DAYS"] = 7  # done/failed rows are purged this long after they were due
+app.config["LOCATION_KEEP"] = 20  # pings kept per delivery after compaction
+
+# How long a form's idempotency key is remembered (replays inside this window are absorbed)
+app.config["IDEMPOTENCY_TTL_SECONDS"] = 24 * 60 * 60
+
+# Kitchen admission control: checkout is refused once a restaurant has this many
+# Placed/Accepted/Preparing orders (Restaurant.max_in_flight overrides; 0 = no limit).
+# Off by default: nothing cancels a stuck Placed order, so a default limit would
+# eventually lock out every restaurant; admins opt kitchens in with max_in_flight.
+# With CAPACITY_QUEUE_SECONDS > 0 a checkout waits that long for a slot first.
+# A full restaurant shows as Busy until its load drops to CAPACITY_RESUME_RATIO x limit.
+app.config["CAPACITY_DEFAULT_LIMIT"] = 0
+app.config["CAPACITY_RESUME_RATIO"] = 0.8
+app.config["CAPACITY_QUEUE_SECONDS"] = 0
+app.config["CAPACITY_RESYNC_SECONDS"] = 30  # re-read counts from SQL (other workers' orders)
+
+# Public lookups (/track, /my-orders) are throttled with token buckets of
+# (requests per minute, burst) checked before any SQL runs. Buckets live in
+# process memory, or with RATE_LIMIT_SHARED_DIR set in an mmap'd file shared by
+# all workers (POSIX only). Behind a reverse proxy, wrap app.wsgi_app in
+# werkzeug's ProxyFix so request.remote_addr is the client's address.
+app.config["RATE_LIMIT_ENABLED"] = True
+app.config["RATE_LIMITS"] = {
+    "track-ip": (30, 20),  # /track per client IP
+    "track-code": (60, 30),  # /track per tracking code
+    "lookup-ip": (10, 5),  # /my-orders per client IP
+    "lookup-phone": (6, 3),  # /my-orders per phone number
+}
+app.config["RATE_LIMIT_SHARED_DIR"] = None
+app.config["RATE_LIMIT_MAX_KEYS"] = 100_000  # in-memory buckets kept (least recently used evicted)
+# Unknown tracking codes are answered without SQL for NOT_FOUND_CACHE_SECONDS. A new
+# code is dropped from this cache at checkout; with several workers that only
+# reaches the others when RATE_LIMIT_SHARED_DIR is set (the cache is shared there too).
+app.config["NOT_FOUND_CACHE_SECONDS"] = 60
+
+# Password hashing: a Werkzeug method string (hashes stored with other parameters
+# are upgraded on the next successful login). Hashes run in a pool of
+# PASSWORD_WORKERS processes (0 = on the request thread) with at most
+# PASSWORD_MAX_PENDING waiting; verified logins are remembered in memory for
+# PASSWORD_CACHE_SECONDS so a repeat login skips the hash.
+app.config["PASSWORD_METHOD"] = "scrypt:32768:8:1"
+app.config["PASSWORD_WORKERS"] = min(4, os.cpu_count() or 1)
+app.config["PASSWORD_MAX_PENDING"] = 64
+app.config["PASSWORD_WAIT_SECONDS"] = 10
+app.config["PASSWORD_CACHE_SECONDS"] = 15 * 60
+app.config["PASSWORD_CACHE_MAX"] = 10_000
+
+# Order-event outbox read through /api/events. Consumers authenticate with
+# "Authorization: Bearer <EVENTS_TOKEN>" (or an Admin session). An event_id is
+# taken at INSERT but only visible at COMMIT, so a batch stops at the first
+# missing id until the event after it is EVENTS_GAP_SECONDS old; after that the
+# gap is taken to be a rolled-back transaction. Keep it well above the longest
+# write transaction (innodb_lock_wait_timeout is 50s per statement by default).
+app.config["EVENTS_TOKEN"] = os.environ.get("EVENTS_TOKEN")
+app.config["EVENTS_GAP_SECONDS"] = 5 * 60
+app.config["EVENTS_BATCH_MAX"] = 1000
+app.config["EVENTS_POLL_SECONDS"] = 0.5  # stream re-check interval when caught up
+app.config["EVENTS_RETENTION_DAYS"] = 7
+
+# "Near me": open restaurants with coordinates are kept in an in-process grid of
+# GEO_CELL_KM cells, so a nearest-k query only looks at cells around the customer.
+# Checkouts that send the customer's coordinates are refused beyond
+# GEO_DELIVERY_RADIUS_KM. Other workers' edits show up after GEO_RESYNC_SECONDS.
+app.config["GEO_CELL_KM"] = 1.0
+app.config["GEO_DELIVERY_RADIUS_KM"] = 8.0
+app.config["GEO_NEAR_LIMIT"] = 20  # restaurants listed by /restaurants?lat=&lng=
+app.config["GEO_RESYNC_SECONDS"] = 60
+
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, record):
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")  # stays "memory" for in-memory databases
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.close()
+
+
 # -------------------- MODELS --------------------
 class User(db.Model):
     __tablename__ = "users"
@@ -45,6 +203,15 @@ class Restaurant(db.Model):
     address = db.Column(db.String(255), nullable=False)
     status = db.Column(db.String(20), nullable=False, default="Active")  # Active / Inactive / Busy
     created_at = db.Column(db.DateTime, server_default=func.current_timestamp(), nullable=False)
+    # Kitchen capacity: in-flight order limit (NULL = CAPACITY_DEFAULT_LIMIT, 0 = unlimited);
+    # auto_busy marks a Busy status set by the capacity tracker rather than by an admin
+    max_in_flight = db.Column(db.Integer, nullable=True)
+    auto_busy = db.Column(db.Boolean, nullable=False, default=False)
+    # Bumped once per flush that changes this menu or the restaurant's name/address/status; see MENU SYNC
+    menu_version = db.Column(db.BigInteger, nullable=False, default=0)
+    # WGS84 degrees; restaurants without them are left out of "near me" (see GEO)
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
 
     owner = db.relationship("User", foreign_keys=[owner_id])
 
@@ -58,10 +225,27 @@ class MenuItem(db.Model):
     category = db.Column(db.String(20), nullable=True)  # Food / Drink
     availability = db.Column(db.Boolean, nullable=False, default=True)
     created_at = db.Column(db.DateTime, server_default=func.current_timestamp(), nullable=False)
+    version = db.Column(db.BigInteger, nullable=False, default=0)  # restaurants.menu_version of the last change
 
     restaurant = db.relationship("Restaurant", backref=db.backref("menu_items", lazy=True))
 
 
+# Menu delta sync: WHERE restaurant_id = ? AND version > ?
+db.Index("idx_menu_items_version", MenuItem.restaurant_id, MenuItem.version)
+
+
+class MenuTombstone(db.Model):
+    """A deleted menu item, kept so delta sync can tell clients to drop it."""
+    __tablename__ = "menu_item_tombstones"
+    tombstone_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    restaurant_id = db.Column(db.Integer, nullable=False)
+    menu_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+db.Index("idx_menu_tombstones_version", MenuTombstone.restaurant_id, MenuTombstone.version)
+
+
 class Order(db.Model):
     __tablename__ = "orders"
     order_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -84,11 +268,20 @@ class Order(db.Model):
     customer_name = db.Column(db.String(120), nullable=True)
     customer_phone = db.Column(db.String(30), nullable=True)
     customer_address = db.Column(db.String(255), nullable=True)
+    # Normalized (E.164-style) form of customer_phone, used for My Orders lookups
+    customer_phone_key = db.Column(db.String(16), nullable=True)
+    # Delivery point, when the customer shared their location at checkout
+    customer_latitude = db.Column(db.Float, nullable=True)
+    customer_longitude = db.Column(db.Float, nullable=True)
 
     user = db.relationship("User", backref=db.backref("orders", lazy=True))
     restaurant = db.relationship("Restaurant", backref=db.backref("orders", lazy=True))
 
 
+# My Orders: WHERE customer_phone_key = ? ORDER BY order_id DESC LIMIT 100
+db.Index("idx_orders_phone_key", Order.customer_phone_key, Order.order_id.desc())
+
+
 class OrderItem(db.Model):
     __tablename__ = "order_items"
     orderitem_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -142,25 +335,176 @@ class DeliveryLocation(db.Model):
     delivery = db.relationship("DeliveryAssignment", backref=db.backref("locations", lazy=True, cascade="all, delete-orphan"))
 
 
+class Cart(db.Model):
+    __tablename__ = "carts"
+    cart_id = db.Column(db.String(32), primary_key=True)
+    restaurant_id = db.Column(db.Integer, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    lines = db.relationship("CartLine", lazy=True, cascade="all, delete-orphan")
+
+
+class CartLine(db.Model):
+    __tablename__ = "cart_items"
+    cart_id = db.Column(db.String(32), db.ForeignKey("carts.cart_id", ondelete="CASCADE"), primary_key=True)
+    menu_item_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(60), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default="{}")
+    status = db.Column(db.String(20), nullable=False, default="queued")  # queued / running / done / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(60), nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+db.Index("idx_jobs_due", Job.status, Job.run_at)
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_keys"
+    key = db.Column(db.String(64), primary_key=True)
+    scope = db.Column(db.String(40), nullable=False)
+    result_url = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class OrderEvent(db.Model):
+    __tablename__ = "order_events"
+    # Consumers resume from the last event_id they saw, so ids must never be
+    # reused once purged (a bare SQLite rowid restarts at max(rowid) + 1)
+    __table_args__ = {"sqlite_autoincrement": True}
+    event_id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True, autoincrement=True)
+    order_id = db.Column(db.Integer, nullable=False)  # no FK: events outlive deleted orders
+    type = db.Column(db.String(30), nullable=False)  # see ORDER_EVENT_TYPES
+    payload = db.Column(db.Text, nullable=False, default="{}")
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+@event.listens_for(DeliveryAssignment, "before_insert")
+@event.listens_for(DeliveryAssignment, "before_update")
+def _delivery_agent_must_be_agent(mapper, connection, target):
+    # Portable form of the MySQL trigger trg_delivery_agent_must_be_agent
+    agent_type = connection.execute(
+        db.select(User.type).where(User.user_id == target.delivery_agent_id)
+    ).scalar()
+    if agent_type != "Delivery Agent":
+        raise ValueError("delivery_agent_id must be a Delivery Agent")
+
+
 # -------------------- HELPERS --------------------
+# Money: in-memory totals, carts and rollups are integer cents (paisa).
+# Decimal only appears at the edges: Numeric(10,2) columns and display strings.
+def to_cents(x) -> int:
+    if isinstance(x, int):
+        return x * 100
+    if not isinstance(x, Decimal):
+        x = Decimal(str(x))
+    # Numeric(10,2) values are exact fractions over 100: skip Decimal rounding
+    num, den = x.as_integer_ratio()
+    if 100 % den == 0:
+        return num * (100 // den)
+    return int(x.scaleb(2).to_integral_value(ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> Decimal:
+    """Exact Decimal for writing cents back into a Numeric(10,2) column."""
+    return Decimal(cents).scaleb(-2)
+
+
+def cents_str(cents: int | None) -> str:
+    if not cents:
+        return "0.00"
+    sign = "-" if cents < 0 else ""
+    whole, frac = divmod(abs(cents), 100)
+    return f"{sign}{whole}.{frac:02d}"
+
+
 def money_str(x) -> str:
     if x is None:
         return "0.00"
+    if isinstance(x, Decimal):
+        return f"{x:.2f}"
     try:
         return f"{Decimal(str(x)):.2f}"
     except Exception:
         return str(x)
 
 
+DEFAULT_COUNTRY_CODE = "92"
+
+
+def normalize_phone(raw: str | None) -> str | None:
+    """
+    Normalizes a typed phone number to an E.164-style key ("+923001234567").
+    "0300-1234567", "+92 300 1234567" and "0092 300 1234567" all map to the same key.
+    Returns None when the input cannot be a phone number.
+    """
+    raw = (raw or "").strip()
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    if not digits:
+        return None
+
+    if raw.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        digits = DEFAULT_COUNTRY_CODE + digits[1:]
+    elif len(digits) == 10:
+        # National number typed without the trunk prefix (3001234567)
+        digits = DEFAULT_COUNTRY_CODE + digits
+
+    if not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+def backfill_phone_keys(batch_size: int = 1000) -> int:
+    """
+    Fills customer_phone_key for orders placed before the column existed.
+    Works in batches of primary-key UPDATEs; returns the number of rows touched.
+    """
+    touched = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(Order.order_id, Order.customer_phone)
+            .where(Order.order_id > last_id)
+            .where(Order.customer_phone_key.is_(None))
+            .where(Order.customer_phone.isnot(None))
+            .order_by(Order.order_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return touched
+        last_id = rows[-1].order_id
+
+        params = []
+        for oid, phone in rows:
+            key = normalize_phone(phone)
+            if key:
+                params.append({"order_id": oid, "customer_phone_key": key})
+        if params:
+            db.session.execute(db.update(Order), params)
+            db.session.commit()
+            touched += len(params)
+
+
 def now_utc() -> datetime:
     return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
-def calc_order_total(order: Order) -> Decimal:
-    total = Decimal("0.00")
-    for it in order.items:
-        total += Decimal(str(it.price_at_purchase)) * Decimal(str(it.quantity))
-    return total
+def order_total_cents(order: Order) -> int:
+    return sum(to_cents(it.price_at_purchase) * it.quantity for it in order.items)
 
 
 def log_history(order_id: int, status: str, actor_user_id: int | None, note: str | None = None) -> None:
@@ -219,6 +563,1611 @@ def generate_tracking_code(n: int = 10) -> str:
             return code
 
 
+# -------------------- MENU SNAPSHOTS --------------------
+# Cart add, cart view, reorder and checkout read menu items from a packed,
+# read-only per-restaurant snapshot instead of querying menu_items per line.
+# Snapshot layout (little-endian):
+#   header  <4s Q I B I Q> magic, version, restaurant_id, status code, n items,
+#                         restaurants.menu_version the snapshot was built from
+#   ids     n x int64     sorted ascending (looked up with bisect)
+#   prices  n x int64     price in cents
+#   flags   n x uint8     bit0 = available, bits1-2 = category code
+#   offsets (n+1) x uint32 into the UTF-8 name blob
+#   names   UTF-8 blob
+SNAPSHOT_MAGIC = b"FAM2"
+SNAPSHOT_HEADER = struct.Struct("<4sQIBIQ")
+RESTAURANT_STATUSES = ("Active", "Inactive", "Busy")
+MENU_CATEGORIES = (None, "Food", "Drink")
+MENU_VERSION_SLOTS = 65536
+
+
+class SnapshotItem:
+    __slots__ = ("menu_id", "name", "price_cents", "category", "availability")
+
+    def __init__(self, menu_id, name, price_cents, category, availability):
+        self.menu_id = menu_id
+        self.name = name
+        self.price_cents = price_cents
+        self.category = category
+        self.availability = availability
+
+    @property
+    def price(self) -> Decimal:
+        return from_cents(self.price_cents)
+
+
+class MenuSnapshot:
+    """Read-only view over packed snapshot bytes (a bytes object or an mmap)."""
+    __slots__ = ("buf", "version", "restaurant_id", "status", "n", "menu_version", "loaded_at",
+                 "_ids", "_prices", "_flags", "_offsets", "_names")
+
+    def __init__(self, buf, loaded_at: float):
+        magic, self.version, self.restaurant_id, status, n, self.menu_version = SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a menu snapshot.")
+        self.buf = buf
+        self.status = RESTAURANT_STATUSES[status]
+        self.n = n
+        self.loaded_at = loaded_at
+
+        view = memoryview(buf)
+        pos = SNAPSHOT_HEADER.size
+        pos += -pos % 8
+        self._ids = view[pos:pos + 8 * n].cast("q")
+        pos += 8 * n
+        self._prices = view[pos:pos + 8 * n].cast("q")
+        pos += 8 * n
+        self._flags = view[pos:pos + n]
+        pos += n
+        pos += -pos % 4
+        self._offsets = view[pos:pos + 4 * (n + 1)].cast("I")
+        pos += 4 * (n + 1)
+        self._names = view[pos:]
+
+    @staticmethod
+    def pack(version: int, restaurant_id: int, status: str, rows, menu_version: int = 0) -> bytes:
+        """rows: (menu_id, name, price, category, availability), sorted by menu_id."""
+        n = len(rows)
+        names = [r[1].encode("utf-8") for r in rows]
+        offsets = [0]
+        for b in names:
+            offsets.append(offsets[-1] + len(b))
+
+        out = bytearray(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, version, restaurant_id, RESTAURANT_STATUSES.index(status), n, menu_version
+        ))
+        out += bytes(-len(out) % 8)
+        out += struct.pack(f"<{n}q", *(r[0] for r in rows))
+        out += struct.pack(f"<{n}q", *(to_cents(r[2]) for r in rows))
+        out += bytes(
+            (1 if r[4] else 0) | (MENU_CATEGORIES.index(r[3] if r[3] in MENU_CATEGORIES else None) << 1)
+            for r in rows
+        )
+        out += bytes(-len(out) % 4)
+        out += struct.pack(f"<{n + 1}I", *offsets)
+        out += b"".join(names)
+        return bytes(out)
+
+    def _item(self, i: int) -> SnapshotItem:
+        flags = self._flags[i]
+        return SnapshotItem(
+            self._ids[i],
+            bytes(self._names[self._offsets[i]:self._offsets[i + 1]]).decode("utf-8"),
+            self._prices[i],
+            MENU_CATEGORIES[flags >> 1],
+            bool(flags & 1),
+        )
+
+    def get(self, menu_id: int) -> SnapshotItem | None:
+        i = bisect_left(self._ids, menu_id)
+        if i < self.n and self._ids[i] == menu_id:
+            return self._item(i)
+        return None
+
+    def items(self) -> list[SnapshotItem]:
+        return [self._item(i) for i in range(self.n)]
+
+
+class MenuVersions:
+    """
+    Per-restaurant version counters. A bump stores time_ns(), so writers never
+    read-modify-write; a torn read at worst costs one extra rebuild.
+    With a path, counters live in an mmap'd file shared by every worker.
+    """
+
+    def __init__(self, path: str | None = None):
+        self._local: dict[int, int] = {}
+        self._map = None
+        self.epoch = 0
+        if path:
+            size = 8 * (MENU_VERSION_SLOTS + 1)
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+                os.write(fd, struct.pack("<Q", secrets.randbits(63)) + bytes(size - 8))
+            except FileExistsError:
+                fd = os.open(path, os.O_RDWR)
+            self._map = mmap.mmap(fd, size)
+            os.close(fd)
+            (self.epoch,) = struct.unpack_from("<Q", self._map, 0)
+
+    def get(self, rid: int) -> int:
+        if self._map is None:
+            return self._local.get(rid, 0)
+        return struct.unpack_from("<Q", self._map, 8 * (1 + rid % MENU_VERSION_SLOTS))[0]
+
+    def bump(self, rid: int) -> None:
+        v = time.time_ns()
+        if self._map is None:
+            self._local[rid] = v
+        else:
+            struct.pack_into("<Q", self._map, 8 * (1 + rid % MENU_VERSION_SLOTS), v)
+
+
+class MenuSnapshotCache:
+    def __init__(self, shared_dir: str | None, max_age: float):
+        self.shared_dir = shared_dir
+        self.max_age = max_age
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+            self.versions = MenuVersions(os.path.join(shared_dir, "menu-versions.bin"))
+        else:
+            self.versions = MenuVersions()
+        self._snaps: dict[int, MenuSnapshot] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, rid: int, version: int) -> str:
+        return os.path.join(self.shared_dir, f"{self._prefix(rid)}{version}.bin")
+
+    def _prefix(self, rid: int) -> str:
+        return f"menu-{SNAPSHOT_MAGIC.decode()}-{self.versions.epoch:x}-{rid}-"
+
+    def _build(self, rid: int, version: int) -> bytes | None:
+        head = db.session.execute(
+            db.select(Restaurant.status, Restaurant.menu_version).where(Restaurant.restaurant_id == rid)
+        ).first()
+        if head is None:
+            return None
+        status, menu_version = head
+        rows = db.session.execute(
+            db.select(MenuItem.menu_id, MenuItem.name, MenuItem.price, MenuItem.category, MenuItem.availability)
+            .where(MenuItem.restaurant_id == rid)
+            .order_by(MenuItem.menu_id)
+        ).all()
+        return MenuSnapshot.pack(version, rid, status, rows, menu_version or 0)
+
+    def _load_shared(self, rid: int, version: int) -> MenuSnapshot | None:
+        path = self._path(rid, version)
+        if not os.path.exists(path):
+            data = self._build(rid, version)
+            if data is None:
+                return None
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return MenuSnapshot(buf, time.monotonic())
+
+    def get(self, rid: int, current: bool = False) -> MenuSnapshot | None:
+        """
+        With `current`, the snapshot is also checked against restaurants.menu_version
+        (one primary-key read), so an edit committed by any worker is never missed.
+        """
+        if current:
+            snap = self.get(rid)
+            if snap is None:
+                return None
+            menu_version = db.session.execute(
+                db.select(Restaurant.menu_version).where(Restaurant.restaurant_id == rid)
+            ).scalar()
+            if menu_version is None or snap.menu_version >= menu_version:
+                return snap if menu_version is not None else None
+            self.invalidate(rid)  # the committing worker's invalidate() did not reach us
+
+        version = self.versions.get(rid)
+        snap = self._snaps.get(rid)
+        if snap is not None and snap.version == version:
+            if self.shared_dir or time.monotonic() - snap.loaded_at < self.max_age:
+                return snap
+
+        with self._lock:
+            if self.shared_dir:
+                snap = self._load_shared(rid, version)
+            else:
+                data = self._build(rid, version)
+                snap = MenuSnapshot(data, time.monotonic()) if data is not None else None
+            if snap is None:
+                self._snaps.pop(rid, None)
+            else:
+                self._snaps[rid] = snap
+            return snap
+
+    def invalidate(self, rid: int) -> None:
+        self.versions.bump(rid)
+        self._snaps.pop(rid, None)
+        if self.shared_dir:
+            # Readers that still map an old file keep their pages until they re-check
+            prefix = self._prefix(rid)
+            for name in os.listdir(self.shared_dir):
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.shared_dir, name))
+                    except FileNotFoundError:
+                        pass
+
+
+menu_cache = MenuSnapshotCache(app.config["MENU_SHARED_DIR"], app.config["MENU_SNAPSHOT_MAX_AGE"])
+
+
+def menu_snapshot(rid: int, current: bool = False) -> MenuSnapshot | None:
+    return menu_cache.get(rid, current)
+
+
+# -------------------- MENU SYNC --------------------
+# Offline clients keep a copy of each menu and ask for what changed since the
+# restaurants.menu_version they hold (GET /api/menu/<rid>?since=N). Every flush
+# that touches a menu bumps that counter once, stamps the changed
+# rows with the new value and records deletions as tombstones; edits to the
+# restaurant's name, address or status bump it too, since clients keep those with
+# the menu. The bump is an UPDATE of the restaurant row, so concurrent menu writes
+# commit in version order.
+def next_menu_version(conn, rid: int) -> int:
+    table = Restaurant.__table__
+    conn.execute(db.update(table).where(table.c.restaurant_id == rid)
+                 .values(menu_version=table.c.menu_version + 1))
+    return conn.execute(db.select(table.c.menu_version).where(table.c.restaurant_id == rid)).scalar() or 0
+
+
+MENU_SYNC_RESTAURANT_FIELDS = ("name", "address", "status")
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _version_menu_changes(session, flush_context, instances):
+    changed: dict[int, list[MenuItem]] = {}
+    deleted: dict[int, list[MenuItem]] = {}
+    for obj in session.new:
+        if isinstance(obj, MenuItem) and obj.restaurant_id is not None:
+            changed.setdefault(obj.restaurant_id, []).append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, MenuItem) and session.is_modified(obj):
+            changed.setdefault(obj.restaurant_id, []).append(obj)
+    for obj in session.deleted:
+        if isinstance(obj, MenuItem):
+            deleted.setdefault(obj.restaurant_id, []).append(obj)
+    # The synced copy also carries the restaurant's name, address and status
+    renamed = {
+        obj.restaurant_id for obj in session.dirty
+        if isinstance(obj, Restaurant) and any(
+            inspect(obj).attrs[f].history.has_changes() for f in MENU_SYNC_RESTAURANT_FIELDS)
+    }
+    if not changed and not deleted and not renamed:
+        return
+
+    conn = session.connection()
+    for rid in changed.keys() | deleted.keys() | renamed:
+        v = next_menu_version(conn, rid)
+        for obj in changed.get(rid, ()):
+            obj.version = v
+        for obj in deleted.get(rid, ()):
+            session.add(MenuTombstone(restaurant_id=rid, menu_id=obj.menu_id, version=v))
+
+
+def menu_delta(rid: int, since: int) -> dict | None:
+    """Items changed and ids deleted after version `since` (everything when since=0)."""
+    r = db.session.execute(
+        db.select(Restaurant.restaurant_id, Restaurant.name, Restaurant.address, Restaurant.status,
+                  Restaurant.menu_version)
+        .where(Restaurant.restaurant_id == rid)
+    ).first()
+    if r is None:
+        return None
+    if since > r.menu_version:
+        since = 0  # the client's copy came from another database: start over
+    items = db.select(MenuItem.menu_id, MenuItem.name, MenuItem.price, MenuItem.category, MenuItem.availability) \
+        .where(MenuItem.restaurant_id == rid).order_by(MenuItem.menu_id)
+    deleted = []
+    if since:
+        items = items.where(MenuItem.version > since)
+        deleted = db.session.execute(
+            db.select(MenuTombstone.menu_id)
+            .where(MenuTombstone.restaurant_id == rid, MenuTombstone.version > since)
+        ).scalars().all()
+    return {
+        "restaurant": {"id": r.restaurant_id, "name": r.name, "address": r.address, "status": r.status},
+        "version": r.menu_version,
+        "full": not since,
+        "items": [
+            {"id": m.menu_id, "name": m.name, "price_cents": to_cents(m.price), "category": m.category,
+             "available": bool(m.availability)}
+            for m in db.session.execute(items)
+        ],
+        "deleted": sorted(set(deleted)),
+    }
+
+
+# -------------------- PROFILING --------------------
+perf_log = logging.getLogger("fa.perf")
+PERF_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, float("inf"))
+
+
+def param_shape(params) -> str:
+    """Types of bound parameters, not values: "(int, str)", "{name: str}", "[50 x (int,)]"."""
+    if params is None:
+        return "()"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    if isinstance(params, list):
+        return f"[{len(params)} x {param_shape(params[0]) if params else '()'}]"
+    if isinstance(params, tuple):
+        return "(" + ", ".join(type(v).__name__ for v in params) + ("," if len(params) == 1 else "") + ")"
+    return type(params).__name__
+
+
+class RequestProfile:
+    __slots__ = ("started", "sql_ms", "render_ms", "statements", "_render_started", "_render_sql_ms")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_ms = 0.0
+        self.render_ms = 0.0
+        self.statements: list[tuple[str, str, float]] = []  # (sql, param shape, ms)
+        self._render_started = None
+        self._render_sql_ms = 0.0
+
+    def n_plus_one(self, threshold: int) -> list[tuple[str, int]]:
+        counts: dict[str, int] = {}
+        for sql, _, _ in self.statements:
+            counts[sql] = counts.get(sql, 0) + 1
+        return sorted(((sql, n) for sql, n in counts.items() if n >= threshold), key=lambda x: -x[1])
+
+    def slowest(self, n: int) -> list[tuple[str, str, float]]:
+        return sorted(self.statements, key=lambda x: -x[2])[:n]
+
+
+class EndpointStats:
+    __slots__ = ("count", "buckets", "totals", "queries", "sql_ms", "render_ms", "n_plus_one")
+
+    def __init__(self, window: int):
+        self.count = 0
+        self.buckets = [0] * len(PERF_BUCKETS_MS)
+        self.totals = deque(maxlen=window)
+        self.queries = deque(maxlen=window)
+        self.sql_ms = deque(maxlen=window)
+        self.render_ms = deque(maxlen=window)
+        self.n_plus_one = 0
+
+    def add(self, total_ms: float, queries: int, sql_ms: float, render_ms: float, n_plus_one: bool) -> None:
+        self.count += 1
+        self.buckets[bisect_left(PERF_BUCKETS_MS, total_ms)] += 1
+        self.totals.append(total_ms)
+        self.queries.append(queries)
+        self.sql_ms.append(sql_ms)
+        self.render_ms.append(render_ms)
+        self.n_plus_one += int(n_plus_one)
+
+
+def percentile(sorted_vals, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(p / 100 * len(sorted_vals)))]
+
+
+perf_stats: dict[str, EndpointStats] = {}
+perf_lock = threading.Lock()
+
+
+def _profile() -> RequestProfile | None:
+    return g.get("prof") if has_request_context() else None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _prof_before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _profile() is not None:
+        conn.info.setdefault("prof_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _prof_after_execute(conn, cursor, statement, parameters, context, executemany):
+    prof = _profile()
+    started = conn.info.get("prof_started")
+    if prof is None or not started:
+        return
+    ms = (time.perf_counter() - started.pop()) * 1000
+    prof.sql_ms += ms
+    prof.statements.append((statement, param_shape(parameters), ms))
+
+
+@before_render_template.connect_via(app)
+def _prof_before_render(sender, template, context, **extra):
+    prof = _profile()
+    if prof is not None:
+        prof._render_started = time.perf_counter()
+        prof._render_sql_ms = prof.sql_ms
+
+
+@template_rendered.connect_via(app)
+def _prof_after_render(sender, template, context, **extra):
+    prof = _profile()
+    if prof is not None and prof._render_started is not None:
+        # Lazy loads fired from the template are already counted as SQL time
+        lazy_sql_ms = prof.sql_ms - prof._render_sql_ms
+        prof.render_ms += (time.perf_counter() - prof._render_started) * 1000 - lazy_sql_ms
+        prof._render_started = None
+
+
+@app.before_request
+def start_profile():
+    if app.config["PROFILING"]:
+        g.prof = RequestProfile()
+
+
+@app.after_request
+def finish_profile(response):
+    prof = g.pop("prof", None)
+    if prof is None:
+        return response
+
+    total_ms = (time.perf_counter() - prof.started) * 1000
+    python_ms = max(0.0, total_ms - prof.sql_ms - prof.render_ms)
+    queries = len(prof.statements)
+    n_plus_one = prof.n_plus_one(app.config["PROFILING_N_PLUS_ONE"])
+    endpoint = request.endpoint or "<unmatched>"
+
+    response.headers["Server-Timing"] = ", ".join([
+        f'sql;dur={prof.sql_ms:.2f};desc="{queries} queries"',
+        f"tpl;dur={prof.render_ms:.2f}",
+        f"py;dur={python_ms:.2f}",
+        f"total;dur={total_ms:.2f}",
+    ])
+
+    perf_log.info(json.dumps({
+        "endpoint": endpoint,
+        "method": request.method,
+        "status": response.status_code,
+        "total_ms": round(total_ms, 2),
+        "sql_ms": round(prof.sql_ms, 2),
+        "render_ms": round(prof.render_ms, 2),
+        "python_ms": round(python_ms, 2),
+        "queries": queries,
+        "slowest": [
+            {"sql": sql[:200], "params": shape, "ms": round(ms, 2)}
+            for sql, shape, ms in prof.slowest(app.config["PROFILING_SLOW_QUERIES"])
+        ],
+        "n_plus_one": [{"sql": sql[:200], "count": n} for sql, n in n_plus_one],
+    }))
+
+    with perf_lock:
+        stats = perf_stats.get(endpoint)
+        if stats is None:
+            stats = perf_stats[endpoint] = EndpointStats(app.config["PROFILING_WINDOW"])
+        stats.add(total_ms, queries, prof.sql_ms, prof.render_ms, bool(n_plus_one))
+    return response
+
+
+# -------------------- METRICS --------------------
+# Writers never take a lock: each thread owns a shard of plain dicts, and a
+# scrape sums the shards (and, with METRICS_DIR, the other workers' dumps).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_BUCKETS = (60, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200)
+
+
+class _MetricsShard:
+    """One thread's (counters, histograms); weakly referenceable so its exit can be noticed."""
+    __slots__ = ("data", "__weakref__")
+
+    def __init__(self):
+        self.data: tuple[dict, dict] = ({}, {})
+
+
+def _merge_shard(into: tuple[dict, dict], shard: tuple[dict, dict]) -> None:
+    counters, hists = into
+    for key, v in list(shard[0].items()):
+        counters[key] = counters.get(key, 0) + v
+    for key, v in list(shard[1].items()):
+        acc = hists.get(key)
+        hists[key] = list(v) if acc is None else [a + b for a, b in zip(acc, v)]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.meta: dict[str, tuple[str, str, tuple | None]] = {}  # name -> (type, help, buckets)
+        self._gauges: dict[str, object] = {}  # name -> fn() -> [(labels, value)]
+        self._local = threading.local()
+        self._shards: dict[int, tuple[dict, dict]] = {}  # live threads only
+        self._retired: tuple[dict, dict] = ({}, {})  # folded in from threads that have exited
+        self._shards_lock = threading.RLock()  # taken once per thread, on first write and at exit
+        self._flushed_at = 0.0
+
+    def counter(self, name: str, help_: str) -> None:
+        self.meta[name] = ("counter", help_, None)
+
+    def histogram(self, name: str, help_: str, buckets: tuple) -> None:
+        self.meta[name] = ("histogram", help_, buckets)
+
+    def gauge(self, name: str, help_: str, fn) -> None:
+        """Computed at scrape time (from shared state, so never merged across workers)."""
+        self.meta[name] = ("gauge", help_, None)
+        self._gauges[name] = fn
+
+    def _shard(self) -> tuple[dict, dict]:
+        holder = getattr(self._local, "shard", None)
+        if holder is None:
+            # The dev server starts a thread per request: when the thread (and
+            # with it the thread-local holder) goes away, fold its shard into
+            # _retired so the shard list stays as long as the live thread count
+            holder = self._local.shard = _MetricsShard()
+            with self._shards_lock:
+                self._shards[id(holder)] = holder.data
+            weakref.finalize(holder, self._retire, id(holder))
+        return holder.data
+
+    def _retire(self, key: int) -> None:
+        with self._shards_lock:
+            shard = self._shards.pop(key, None)
+            if shard is not None:
+                _merge_shard(self._retired, shard)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        hists = self._shard()[1]
+        key = (name, labels)
+        h = hists.get(key)
+        if h is None:
+            h = hists[key] = [0] * (len(self.meta[name][2]) + 1) + [0.0]  # buckets..., +Inf, sum
+        h[bisect_left(self.meta[name][2], value)] += 1
+        h[-1] += value
+
+    def totals(self) -> tuple[dict, dict]:
+        """This process's counters and histograms, summed over thread shards."""
+        totals: tuple[dict, dict] = ({}, {})
+        with self._shards_lock:
+            _merge_shard(totals, self._retired)
+            for shard in list(self._shards.values()):
+                _merge_shard(totals, shard)
+        return totals
+
+    def flush(self, directory: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._flushed_at < app.config["METRICS_FLUSH_SECONDS"]:
+            return
+        self._flushed_at = now
+        counters, hists = self.totals()
+        data = {
+            "c": [[n, list(l), v] for (n, l), v in counters.items()],
+            "h": [[n, list(l), v] for (n, l), v in hists.items()],
+        }
+        path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self) -> tuple[dict, dict]:
+        directory = app.config["METRICS_DIR"]
+        if not directory:
+            return self.totals()
+        self.flush(directory, force=True)
+        counters: dict = {}
+        hists: dict = {}
+        for name in os.listdir(directory):
+            if not (name.startswith("metrics-") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for n, l, v in data["c"]:
+                key = (n, tuple(tuple(p) for p in l))
+                counters[key] = counters.get(key, 0) + v
+            for n, l, v in data["h"]:
+                key = (n, tuple(tuple(p) for p in l))
+                acc = hists.get(key)
+                hists[key] = v if acc is None else [a + b for a, b in zip(acc, v)]
+        return counters, hists
+
+    def render(self) -> str:
+        counters, hists = self.collect()
+        out = []
+        for name, (kind, help_, buckets) in self.meta.items():
+            out.append(f"# HELP {name} {help_}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                for labels, v in self._gauges[name]():
+                    out.append(f"{name}{_labels(labels)} {v:g}")
+                continue
+            if kind == "counter":
+                for (n, labels), v in sorted(counters.items()):
+                    if n == name:
+                        out.append(f"{name}{_labels(labels)} {v:g}")
+                continue
+            for (n, labels), h in sorted(hists.items()):
+                if n != name:
+                    continue
+                running = 0
+                for le, count in zip((*buckets, "+Inf"), h[:-1]):
+                    running += count
+                    out.append(f"{name}_bucket{_labels(labels + (('le', f'{le:g}' if le != '+Inf' else le),))} {running}")
+                out.append(f"{name}_sum{_labels(labels)} {h[-1]:g}")
+                out.append(f"{name}_count{_labels(labels)} {running}")
+        return "\n".join(out) + "\n"
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+
+metrics = MetricsRegistry()
+metrics.counter("fa_http_requests_total", "HTTP requests by route, method and status.")
+metrics.histogram("fa_http_request_duration_seconds", "HTTP request latency by route.", LATENCY_BUCKETS)
+metrics.counter("fa_checkouts_total", "Checkout attempts by result (placed/failed/replayed).")
+metrics.counter("fa_db_rollbacks_total", "Session rollbacks by route and exception class.")
+metrics.histogram("fa_order_stage_duration_seconds", "Time between order lifecycle timestamps.", STAGE_BUCKETS)
+
+
+def rollback(exc: BaseException) -> None:
+    """Rolls back the session and counts it by route and exception class."""
+    db.session.rollback()
+    metrics.inc("fa_db_rollbacks_total", (
+        ("route", request.endpoint or "<none>") if has_request_context() else ("route", "<none>"),
+        ("exception", type(exc).__name__),
+    ))
+
+
+ORDER_STAGES = {
+    # status just entered -> [(stage label, start column, end column)]
+    "Accepted": [("placed_to_accepted", "placed_at", "accepted_at")],
+    "Preparing": [("accepted_to_preparing", "accepted_at", "preparing_at")],
+    "Out for Delivery": [("preparing_to_out_for_delivery", "preparing_at", "out_for_delivery_at")],
+    "Delivered": [
+        ("out_for_delivery_to_delivered", "out_for_delivery_at", "delivered_at"),
+        ("placed_to_delivered", "placed_at", "delivered_at"),
+    ],
+}
+
+
+def stage_durations(order: Order) -> list[tuple[str, float]]:
+    """Stage durations completed by the order's current status (read before commit expires them)."""
+    out = []
+    for stage, start_col, end_col in ORDER_STAGES.get(order.status, []):
+        start, end = getattr(order, start_col), getattr(order, end_col)
+        if start and end and end >= start:
+            out.append((stage, (end - start).total_seconds()))
+    return out
+
+
+def observe_stages(durations: list[tuple[str, float]]) -> None:
+    for stage, seconds in durations:
+        metrics.observe("fa_order_stage_duration_seconds", (("stage", stage),), seconds)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        route = request.endpoint or "<unmatched>"
+        metrics.observe("fa_http_request_duration_seconds", (("route", route),), time.perf_counter() - started)
+        metrics.inc("fa_http_requests_total", (("route", route), ("method", request.method), ("status", str(response.status_code))))
+    if app.config["METRICS_DIR"]:
+        metrics.flush(app.config["METRICS_DIR"])
+    return response
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# -------------------- BACKGROUND JOBS --------------------
+# Routes commit their core write and enqueue() secondary work in the same
+# transaction; JobRunner threads claim due rows with a conditional UPDATE
+# (portable across MySQL and SQLite), retry with exponential backoff and
+# requeue jobs whose worker died mid-run.
+job_log = logging.getLogger("fa.jobs")
+JOB_HANDLERS: dict[str, object] = {}
+PERIODIC_JOBS: dict[str, float] = {}  # kind -> interval seconds
+
+
+def job(kind: str, every: float | None = None):
+    """Registers fn(payload: dict) as the handler for `kind`; `every` also schedules it."""
+    def deco(fn):
+        JOB_HANDLERS[kind] = fn
+        if every:
+            PERIODIC_JOBS[kind] = every
+        return fn
+    return deco
+
+
+def enqueue(kind: str, payload: dict | None = None, delay: float = 0, max_attempts: int = 5) -> Job:
+    """Adds a job to the current session; it becomes visible when the caller commits."""
+    now = now_utc()
+    j = Job(kind=kind, payload=json.dumps(payload or {}), status="queued", attempts=0,
+            max_attempts=max_attempts, run_at=now + timedelta(seconds=delay), created_at=now)
+    db.session.add(j)
+    if job_runner is not None:
+        job_runner.wake.set()
+    return j
+
+
+def run_job(job_id: int, worker: str = "inline") -> bool:
+    """Claims and runs one queued job. Returns False if another worker got it first."""
+    now = now_utc()
+    claimed = db.session.execute(
+        db.update(Job)
+        .where(Job.job_id == job_id, Job.status == "queued")
+        .values(status="running", locked_at=now, locked_by=worker, attempts=Job.attempts + 1)
+    ).rowcount
+    db.session.commit()
+    if claimed != 1:
+        return False
+
+    j = db.session.get(Job, job_id)
+    kind, payload, attempts, max_attempts = j.kind, json.loads(j.payload), j.attempts, j.max_attempts
+    started = time.perf_counter()
+    try:
+        handler = JOB_HANDLERS.get(kind)
+        if handler is None:
+            raise LookupError(f"No handler for job kind {kind!r}")
+        handler(payload)
+        db.session.execute(db.update(Job).where(Job.job_id == job_id).values(status="done", locked_at=None))
+        db.session.commit()
+        result = "done"
+    except Exception as e:
+        db.session.rollback()
+        final = attempts >= max_attempts
+        db.session.execute(db.update(Job).where(Job.job_id == job_id).values(
+            status="failed" if final else "queued",
+            run_at=now_utc() + timedelta(seconds=2 ** attempts),
+            locked_at=None,
+            last_error=f"{type(e).__name__}: {e}"[:255],
+        ))
+        db.session.commit()
+        result = "failed" if final else "retry"
+        job_log.warning("job %s (%s) attempt %s: %s", job_id, kind, attempts, e)
+
+    metrics.inc("fa_jobs_total", (("kind", kind), ("result", result)))
+    metrics.observe("fa_job_duration_seconds", (("kind", kind),), time.perf_counter() - started)
+    return True
+
+
+def run_pending_jobs(limit: int = 1000) -> int:
+    """Drains due jobs on the calling thread (tests, benchmarks, in-memory SQLite)."""
+    ran = 0
+    while ran < limit:
+        job_id = db.session.execute(
+            db.select(Job.job_id).where(Job.status == "queued", Job.run_at <= now_utc())
+            .order_by(Job.run_at).limit(1)
+        ).scalar()
+        if job_id is None:
+            break
+        ran += int(run_job(job_id))
+    return ran
+
+
+@job("purge_jobs", every=60 * 60)
+def purge_jobs(payload: dict | None = None) -> int:
+    cutoff = now_utc() - timedelta(days=app.config["JOBS_RETENTION_DAYS"])
+    n = db.session.execute(
+        db.delete(Job).where(Job.status.in_(("done", "failed")), Job.run_at < cutoff)
+    ).rowcount
+    db.session.commit()
+    return n
+
+
+class JobRunner:
+    def __init__(self, workers: int, poll: float):
+        self.poll = poll
+        self.stop_event = threading.Event()
+        self.wake = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._work, name=f"fa-job-{os.getpid()}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self.threads.append(threading.Thread(target=self._schedule, name="fa-job-scheduler", daemon=True))
+
+    def start(self) -> None:
+        for t in self.threads:
+            t.start()
+
+    def stop(self, timeout: float = 10) -> None:
+        """Graceful shutdown: running jobs finish, nothing new is claimed."""
+        self.stop_event.set()
+        self.wake.set()
+        for t in self.threads:
+            t.join(timeout)
+
+    def _work(self) -> None:
+        name = threading.current_thread().name
+        while not self.stop_event.is_set():
+            try:
+                with app.app_context():
+                    job_id = db.session.execute(
+                        db.select(Job.job_id).where(Job.status == "queued", Job.run_at <= now_utc())
+                        .order_by(Job.run_at).limit(1)
+                    ).scalar()
+                    db.session.commit()
+                    if job_id is not None:
+                        run_job(job_id, name)
+                        continue
+            except Exception:
+                job_log.exception("job worker %s", name)
+            self.wake.wait(self.poll)
+            self.wake.clear()
+
+    def _schedule(self) -> None:
+        next_run = {kind: 0.0 for kind in PERIODIC_JOBS}
+        while not self.stop_event.wait(1.0):
+            try:
+                with app.app_context():
+                    self._requeue_stale()
+                    for kind, every in PERIODIC_JOBS.items():
+                        if time.monotonic() < next_run[kind]:
+                            continue
+                        next_run[kind] = time.monotonic() + every
+                        pending = db.session.execute(
+                            db.select(Job.job_id).where(Job.kind == kind, Job.status.in_(("queued", "running"))).limit(1)
+                        ).scalar()
+                        if pending is None:
+                            enqueue(kind)
+                    db.session.commit()
+            except Exception:
+                job_log.exception("job scheduler")
+
+    def _requeue_stale(self) -> None:
+        cutoff = now_utc() - timedelta(seconds=app.config["JOBS_LOCK_TIMEOUT"])
+        db.session.execute(
+            db.update(Job).where(Job.status == "running", Job.locked_at < cutoff)
+            .values(status="queued", locked_at=None, locked_by=None)
+        )
+
+
+job_runner: JobRunner | None = None
+_job_runner_lock = threading.Lock()
+
+
+def start_job_runner() -> JobRunner | None:
+    global job_runner
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if uri in ("sqlite://", "sqlite:///:memory:"):
+        return None
+    with _job_runner_lock:
+        if job_runner is None:
+            job_runner = JobRunner(app.config["JOBS_WORKERS"], app.config["JOBS_POLL_SECONDS"])
+            job_runner.start()
+            atexit.register(job_runner.stop)
+    return job_runner
+
+
+@app.before_request
+def autostart_job_runner():
+    if job_runner is None and app.config["JOBS_AUTOSTART"]:
+        start_job_runner()
+
+
+def _queue_stats():
+    now = now_utc()
+    return db.session.execute(
+        db.select(Job.kind, func.count(), func.min(Job.run_at))
+        .where(Job.status == "queued")
+        .group_by(Job.kind)
+    ).all(), now
+
+
+def _queue_depth():
+    rows, _ = _queue_stats()
+    return [((("kind", kind),), n) for kind, n, _ in rows]
+
+
+def _queue_lag():
+    rows, now = _queue_stats()
+    return [((("kind", kind),), max(0.0, (now - oldest).total_seconds())) for kind, _, oldest in rows]
+
+
+metrics.counter("fa_jobs_total", "Background job runs by kind and result (done/retry/failed).")
+metrics.histogram("fa_job_duration_seconds", "Background job run time by kind.", LATENCY_BUCKETS)
+metrics.gauge("fa_jobs_queue_depth", "Queued background jobs by kind.", _queue_depth)
+metrics.gauge("fa_jobs_queue_lag_seconds", "Age of the oldest due queued job by kind.", _queue_lag)
+
+
+# -------------------- IDEMPOTENCY --------------------
+# State-changing forms carry a hidden "idempotency_key" minted at render time.
+# The key row is inserted in the same transaction as the write it protects, so a
+# resubmit (or a concurrent duplicate blocked on the primary key) finds the
+# committed row and is answered with the original redirect instead of writing again.
+def new_idempotency_key() -> str:
+    return secrets.token_hex(16)
+
+
+@job("purge_idempotency_keys", every=15 * 60)
+def purge_idempotency_keys(payload: dict | None = None) -> int:
+    cutoff = now_utc() - timedelta(seconds=app.config["IDEMPOTENCY_TTL_SECONDS"])
+    n = db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)).rowcount
+    db.session.commit()
+    return n
+
+
+def idempotent_replay(scope: str) -> str | None:
+    """
+    Claims the request's idempotency key for `scope`.
+    Returns None when the caller should proceed (key claimed, or no key sent),
+    otherwise the URL the original request redirected to.
+    Must be called before anything else is added to db.session.
+    """
+    key = (request.form.get("idempotency_key") or "").strip()[:64]
+    if not key:
+        return None
+
+    for _ in range(2):
+        row = IdempotencyKey(key=key, scope=scope, created_at=now_utc())
+        db.session.add(row)
+        try:
+            db.session.flush()
+            g.idempotency_row = row
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        prev = db.session.get(IdempotencyKey, key)
+        if prev and prev.result_url:
+            return prev.result_url
+        # The first attempt rolled back in the meantime; claim the key again.
+    abort(409)
+
+
+def remember_idempotent_result(url: str) -> str:
+    """Stores the redirect target on the claimed key (committed with the caller's write)."""
+    row = getattr(g, "idempotency_row", None)
+    if row is not None:
+        row.result_url = url
+    return url
+
+
+# -------------------- ORDER EVENTS (outbox) --------------------
+# Every order state change adds a typed event row to the same session as the
+# change itself, so an event exists exactly when its change committed. Consumers
+# keep the last event_id they processed and read forward from it, either in
+# batches (GET /api/events) or as a long-lived NDJSON stream (/api/events/stream).
+# Delivery is at-least-once: a consumer that restarts re-reads from its cursor,
+# and reads never pass an id that may still be committing (see EVENTS_GAP_SECONDS;
+# only a transaction open longer than that can still be skipped).
+ORDER_EVENT_TYPES = ("placed", "accepted", "preparing", "assigned", "picked_up", "delivered", "location")
+ORDER_EVENT_FOR_STATUS = {
+    "Placed": "placed",
+    "Accepted": "accepted",
+    "Preparing": "preparing",
+    "Out for Delivery": "picked_up",
+    "Delivered": "delivered",
+}
+
+
+def emit_event(type_: str, order: Order, **data) -> OrderEvent:
+    """Adds an event for `order` to the current session; it is published by the caller's commit."""
+    payload = {"restaurant_id": order.restaurant_id, "status": order.status, **data}
+    ev = OrderEvent(order_id=order.order_id, type=type_, payload=json.dumps(payload, default=str),
+                    created_at=now_utc())
+    db.session.add(ev)
+    return ev
+
+
+def event_dict(ev: OrderEvent) -> dict:
+    return {
+        "event_id": ev.event_id,
+        "type": ev.type,
+        "order_id": ev.order_id,
+        "at": ev.created_at.isoformat() + "Z",
+        "data": json.loads(ev.payload),
+    }
+
+
+def read_events(since: int = 0, limit: int = 100) -> list[OrderEvent]:
+    """
+    Events with event_id > since, oldest first (a primary-key range scan), cut
+    short at the first recent gap in ids: the missing event may still commit.
+    """
+    limit = max(1, min(limit, app.config["EVENTS_BATCH_MAX"]))
+    rows = db.session.execute(
+        db.select(OrderEvent)
+        .where(OrderEvent.event_id > since)
+        .order_by(OrderEvent.event_id)
+        .limit(limit)
+    ).scalars().all()
+    # created_at is set before the INSERT, so a missing id was taken no later than the next row's
+    horizon = now_utc() - timedelta(seconds=app.config["EVENTS_GAP_SECONDS"])
+    expected = since + 1
+    for i, ev in enumerate(rows):
+        if ev.event_id != expected and ev.created_at > horizon:
+            return rows[:i]
+        expected = ev.event_id + 1
+    return rows
+
+
+@job("purge_order_events", every=60 * 60)
+def purge_order_events(payload: dict | None = None) -> int:
+    cutoff = now_utc() - timedelta(days=app.config["EVENTS_RETENTION_DAYS"])
+    # The newest row always stays: it pins the id counter for tables created
+    # without AUTOINCREMENT, and for InnoDB before MySQL 8.0, which resets the
+    # counter to max(id) + 1 on restart
+    newest = db.session.execute(db.select(func.max(OrderEvent.event_id))).scalar() or 0
+    n = db.session.execute(
+        db.delete(OrderEvent).where(OrderEvent.created_at < cutoff, OrderEvent.event_id < newest)
+    ).rowcount
+    db.session.commit()
+    return n
+
+
+def events_consumer_required():
+    token = app.config["EVENTS_TOKEN"]
+    auth = request.headers.get("Authorization", "")
+    if token and auth.startswith("Bearer ") and secrets.compare_digest(auth[7:].strip(), token):
+        return
+    if g.user and g.user.type == "Admin":
+        return
+    abort(401 if not g.user else 403)
+
+
+def _event_cursor() -> tuple[int, int]:
+    try:
+        since = max(0, int(request.args.get("since", 0)))
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        abort(400)
+    return since, limit
+
+
+@app.route("/api/events")
+def api_events():
+    """One batch: {"events": [...], "next": cursor}. Pass `next` back as ?since= to continue."""
+    events_consumer_required()
+    since, limit = _event_cursor()
+    rows = read_events(since, limit)
+    body = {
+        "events": [event_dict(ev) for ev in rows],
+        "next": rows[-1].event_id if rows else since,
+    }
+    return Response(json.dumps(body), mimetype="application/json")
+
+
+@app.route("/api/events/stream")
+def api_events_stream():
+    """
+    Tails the outbox as NDJSON, one event per line, for up to ?timeout= seconds
+    (default 60, max 300). While idle a {"heartbeat": true, "next": cursor} line
+    is sent every 15s so proxies keep the connection and clients can checkpoint.
+    """
+    events_consumer_required()
+    since, limit = _event_cursor()
+    try:
+        timeout = min(max(float(request.args.get("timeout", 60)), 1.0), 300.0)
+    except ValueError:
+        abort(400)
+    poll = app.config["EVENTS_POLL_SECONDS"]
+
+    @stream_with_context
+    def generate():
+        cursor = since
+        deadline = time.monotonic() + timeout
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            batch = [event_dict(ev) for ev in read_events(cursor, limit)]
+            # End the read transaction so the next poll sees newly committed rows (MySQL REPEATABLE READ)
+            db.session.rollback()
+            if batch:
+                cursor = batch[-1]["event_id"]
+                last_sent = time.monotonic()
+                yield "".join(json.dumps(ev) + "\n" for ev in batch)
+                if len(batch) == limit:
+                    continue
+            elif time.monotonic() - last_sent >= 15:
+                last_sent = time.monotonic()
+                yield json.dumps({"heartbeat": True, "next": cursor}) + "\n"
+            time.sleep(poll)
+
+    return Response(generate(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+
+# -------------------- CAPACITY --------------------
+# Each process counts in-flight (Placed/Accepted/Preparing) orders per restaurant
+# in memory: checkout takes a slot, leaving the kitchen (pickup, delivery) frees
+# it. Counts are re-read from SQL every CAPACITY_RESYNC_SECONDS, which also folds
+# in other workers' orders. Busy flips are queued as "capacity_flip" jobs with the
+# order change that caused them and written to restaurants.status, so the
+# listing, the menu snapshot and every worker see them with no extra queries.
+IN_FLIGHT_STATUSES = ("Placed", "Accepted", "Preparing")
+
+
+class AtCapacity(ValueError):
+    pass
+
+
+class CapacityTracker:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._counts: dict[int, int] = {}
+        self._limits: dict[int, int] = {}  # only restaurants with max_in_flight set
+        self._auto_busy: set[int] = set()
+        self._synced_at: float | None = None
+
+    def limit(self, rid: int) -> int:
+        """0 means unlimited."""
+        lim = self._limits.get(rid)
+        return app.config["CAPACITY_DEFAULT_LIMIT"] if lim is None else lim
+
+    def in_flight(self, rid: int) -> int:
+        return self._counts.get(rid, 0)
+
+    def resync(self, force: bool = False) -> None:
+        if (not force and self._synced_at is not None
+                and time.monotonic() - self._synced_at < app.config["CAPACITY_RESYNC_SECONDS"]):
+            return
+        counts = dict(db.session.execute(
+            db.select(Order.restaurant_id, func.count())
+            .where(Order.status.in_(IN_FLIGHT_STATUSES))
+            .group_by(Order.restaurant_id)
+        ).all())
+        rows = db.session.execute(
+            db.select(Restaurant.restaurant_id, Restaurant.max_in_flight, Restaurant.auto_busy)
+            .where((Restaurant.max_in_flight != None) | (Restaurant.auto_busy == True))  # noqa: E711,E712
+        ).all()
+        with self._cond:
+            self._counts = counts
+            self._limits = {rid: lim for rid, lim, _ in rows if lim is not None}
+            self._auto_busy = {rid for rid, _, auto in rows if auto}
+            self._synced_at = time.monotonic()
+            self._cond.notify_all()
+
+    def admit(self, rid: int) -> None:
+        """Takes an in-flight slot, waiting up to CAPACITY_QUEUE_SECONDS; raises AtCapacity."""
+        self.resync()
+        deadline = time.monotonic() + app.config["CAPACITY_QUEUE_SECONDS"]
+        with self._cond:
+            while True:
+                lim = self.limit(rid)
+                if not lim or self._counts.get(rid, 0) < lim:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AtCapacity("This restaurant is at capacity right now. Please try again in a few minutes.")
+                self._cond.wait(remaining)
+            self._counts[rid] = self._counts.get(rid, 0) + 1
+
+    def release(self, rid: int) -> None:
+        with self._cond:
+            self._counts[rid] = max(0, self._counts.get(rid, 0) - 1)
+            self._cond.notify_all()
+
+    def transition(self, rid: int, old_status: str, new_status: str) -> None:
+        if old_status in IN_FLIGHT_STATUSES and new_status not in IN_FLIGHT_STATUSES:
+            self.release(rid)
+
+    def forget_auto_busy(self, rid: int) -> None:
+        with self._cond:
+            self._auto_busy.discard(rid)
+
+    def settle(self, rid: int) -> bool:
+        """
+        Queues a Busy/Active flip for `rid` if its load crossed a threshold; the
+        caller's commit publishes it (see apply_capacity_flip). True if one was queued.
+        """
+        with self._cond:
+            n, lim = self._counts.get(rid, 0), self.limit(rid)
+            if lim and n >= lim and rid not in self._auto_busy:
+                flip = "Busy"
+                self._auto_busy.add(rid)
+            elif rid in self._auto_busy and (not lim or n <= lim * app.config["CAPACITY_RESUME_RATIO"]):
+                flip = "Active"
+                self._auto_busy.discard(rid)
+            else:
+                return False
+        enqueue("capacity_flip", {"restaurant_id": rid, "to": flip})
+        return True
+
+
+capacity = CapacityTracker()
+metrics.counter("fa_restaurant_busy_flips_total", "Automatic restaurant Busy/Active flips.")
+
+
+@job("capacity_flip")
+def apply_capacity_flip(payload: dict) -> None:
+    """Writes a flip queued by CapacityTracker.settle(); never overrides Inactive or an admin's Busy."""
+    rid, flip = payload["restaurant_id"], payload["to"]
+    if flip == "Busy":
+        stmt = (db.update(Restaurant)
+                .where(Restaurant.restaurant_id == rid, Restaurant.status == "Active")
+                .values(status="Busy", auto_busy=True))
+    else:
+        stmt = (db.update(Restaurant)
+                .where(Restaurant.restaurant_id == rid, Restaurant.auto_busy == True)  # noqa: E712
+                .values(status="Active", auto_busy=False))
+    # Bumps menu_version too, so synced menus pick up the new status (see MENU SYNC)
+    changed = db.session.execute(stmt.values(menu_version=Restaurant.menu_version + 1)).rowcount
+    db.session.commit()
+    if changed:
+        menu_cache.invalidate(rid)
+        metrics.inc("fa_restaurant_busy_flips_total", (("to", flip),))
+    elif flip == "Busy":
+        capacity.forget_auto_busy(rid)
+
+
+def admit_checkout(rid: int) -> None:
+    """Holds a slot for this request; it is given back at teardown unless confirm_checkout() ran."""
+    capacity.admit(rid)
+    g.capacity_hold = rid
+
+
+def confirm_checkout() -> None:
+    """Call after the order committed: its slot stays taken until the order leaves IN_FLIGHT_STATUSES."""
+    g.pop("capacity_hold", None)
+
+
+@app.teardown_request
+def release_capacity_hold(exc):
+    rid = g.pop("capacity_hold", None)
+    if rid is not None:
+        capacity.release(rid)
+
+
+# -------------------- GEO --------------------
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180  # along a meridian
+OPEN_STATUSES = ("Active", "Busy")
+
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle (haversine) distance."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def parse_coords(lat_raw, lng_raw) -> tuple[float, float] | None:
+    """(lat, lng) from form/query values; None when both are blank."""
+    lat_raw, lng_raw = (str(lat_raw or "").strip(), str(lng_raw or "").strip())
+    if not lat_raw and not lng_raw:
+        return None
+    try:
+        lat, lng = float(lat_raw), float(lng_raw)
+    except ValueError:
+        raise ValueError("Location must be a latitude and longitude in degrees.") from None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Location is out of range.")
+    return lat, lng
+
+
+def parse_location(raw: str | None) -> tuple[float, float] | None:
+    """Parses "lat, lng" (the admin form's single Location field)."""
+    lat, _, lng = (raw or "").partition(",")
+    return parse_coords(lat, lng)
+
+
+class GeoIndex:
+    """
+    Open restaurants bucketed by (floor(lat / step), floor(lng / step)), step being
+    GEO_CELL_KM in degrees of latitude. nearest() walks square rings of cells outward
+    from the query point and stops once no unvisited cell can hold anything closer
+    than the k-th hit, so its cost follows the restaurants near the customer rather
+    than the size of the catalog. Longitudes do not wrap at +/-180.
+    """
+
+    def __init__(self, cell_km: float):
+        self.step = cell_km / KM_PER_DEGREE
+        self._lock = threading.Lock()
+        self._cells: dict[tuple[int, int], dict[int, tuple[float, float, str]]] = {}
+        self._where: dict[int, tuple[int, int]] = {}
+        self._synced_at: float | None = None
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _cell(self, lat: float, lng: float) -> tuple[int, int]:
+        return math.floor(lat / self.step), math.floor(lng / self.step)
+
+    def _put(self, rid: int, lat: float, lng: float, name: str) -> None:
+        cell = self._cell(lat, lng)
+        self._cells.setdefault(cell, {})[rid] = (lat, lng, name.casefold())
+        self._where[rid] = cell
+
+    def _discard(self, rid: int) -> None:
+        cell = self._where.pop(rid, None)
+        if cell is not None:
+            bucket = self._cells[cell]
+            del bucket[rid]
+            if not bucket:
+                del self._cells[cell]
+
+    def load(self, rows) -> None:
+        """Replaces the contents with (rid, lat, lng, name) rows."""
+        with self._lock:
+            self._cells, self._where = {}, {}
+            for rid, lat, lng, name in rows:
+                self._put(rid, lat, lng, name)
+            self._synced_at = time.monotonic()
+
+    def resync(self, force: bool = False) -> None:
+        if (not force and self._synced_at is not None
+                and time.monotonic() - self._synced_at < app.config["GEO_RESYNC_SECONDS"]):
+            return
+        self.load(db.session.execute(
+            db.select(Restaurant.restaurant_id, Restaurant.latitude, Restaurant.longitude, Restaurant.name)
+            .where(Restaurant.status.in_(OPEN_STATUSES),
+                   Restaurant.latitude != None, Restaurant.longitude != None)  # noqa: E711
+        ).all())
+
+    def update(self, r: Restaurant) -> None:
+        """Applies a committed restaurant edit to this process's index."""
+        with self._lock:
+            self._discard(r.restaurant_id)
+            if r.status in OPEN_STATUSES and r.latitude is not None and r.longitude is not None:
+                self._put(r.restaurant_id, r.latitude, r.longitude, r.name)
+
+    def discard(self, rid: int) -> None:
+        with self._lock:
+            self._discard(rid)
+
+    def location(self, rid: int) -> tuple[float, float] | None:
+        """Coordinates of an open restaurant, if it has any."""
+        self.resync()
+        with self._lock:
+            cell = self._where.get(rid)
+            return self._cells[cell][rid][:2] if cell is not None else None
+
+    def nearest(self, lat: float, lng: float, k: int, radius_km: float,
+                name_contains: str = "") -> list[tuple[float, int]]:
+        """Up to k (distance_km, restaurant_id) pairs within radius_km, closest first."""
+        self.resync()
+        needle = name_contains.casefold()
+        # Longitude cells narrow away from the equator: size the search for the
+        # highest latitude the radius reaches
+        cos_lat = max(math.cos(math.radians(min(90.0, abs(lat) + radius_km / KM_PER_DEGREE))), 1e-6)
+        ring_km = self.step * KM_PER_DEGREE * cos_lat  # an unvisited ring is at least this much further
+        reach_i = math.ceil(radius_km / KM_PER_DEGREE / self.step)
+        # Near the poles cos_lat goes to ~0: no search needs to span more than the
+        # globe's width in cells
+        reach_j = min(math.ceil(radius_km / KM_PER_DEGREE / cos_lat / self.step), math.ceil(360.0 / self.step))
+        ci, cj = self._cell(lat, lng)
+
+        best: list[tuple[float, int]] = []  # max-heap of the k closest, as (-distance, -rid)
+
+        def consider(entries) -> None:
+            for rid, (plat, plng, name) in entries:
+                if needle and needle not in name:
+                    continue
+                d = distance_km(lat, lng, plat, plng)
+                if d > radius_km:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d, -rid))
+                elif (-d, -rid) > best[0]:
+                    heapq.heapreplace(best, (-d, -rid))
+
+        with self._lock:
+            if (2 * reach_i + 1) * (2 * reach_j + 1) > len(self._where):
+                # More cells to visit than restaurants indexed: a plain scan is cheaper
+                for cell in self._cells.values():
+                    consider(cell.items())
+                return sorted((-d, -rid) for d, rid in best)
+
+            for ring in range(max(reach_i, reach_j) + 1):
+                if len(best) == k and (ring - 1) * ring_km > -best[0][0]:
+                    break
+                for di in range(-min(ring, reach_i), min(ring, reach_i) + 1):
+                    step_j = 1 if abs(di) == ring else 2 * ring  # ring edge: every cell, else both ends
+                    for dj in range(-ring, ring + 1, step_j):
+                        if abs(dj) > reach_j:
+                            continue
+                        consider(self._cells.get((ci + di, cj + dj), {}).items())
+        return sorted((-d, -rid) for d, rid in best)
+
+
+geo = GeoIndex(app.config["GEO_CELL_KM"])
+
+
+# -------------------- RATE LIMITING --------------------
+# Token buckets: a key starts with `burst` tokens and refills at `rate` per
+# second; each request takes one. take() returns 0 when allowed, otherwise the
+# seconds until the next token (sent back as Retry-After).
+class TokenBuckets:
+    """Per-process buckets: key -> [tokens, updated]."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                b = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                b[0] = min(burst, b[0] + (now - b[1]) * rate)
+                b[1] = now
+            if b[0] >= 1:
+                b[0] -= 1
+                return 0.0
+            return (1 - b[0]) / rate
+
+
+class SharedTokenBuckets:
+    """
+    Buckets shared by every worker through an mmap'd file of <d d> (tokens, updated)
+    slots addressed by key hash. Colliding keys share a slot, which only ever makes
+    the limit stricter. Each slot is guarded by an fcntl byte-range lock.
+    """
+    SLOT = struct.Struct("<dd")
+
+    def __init__(self, path: str, slots: int = 1 << 18):
+        import fcntl  # POSIX only; the in-memory store works everywhere
+        self._fcntl = fcntl
+        self.slots = slots
+        size = self.SLOT.size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()  # fcntl locks do not exclude threads of one process
+
+    def take(self, key: str, rate: float, burst: float, now: float) -> float:
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        off = self.SLOT.size * (h % self.slots)
+        with self._lock:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.SLOT.size, off)
+            try:
+                tokens, updated = self.SLOT.unpack_from(self._map, off)
+                # A zeroed (never used) slot refills to a full bucket
+                tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self.SLOT.pack_into(self._map, off, tokens, now)
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.SLOT.size, off)
+        return wait
+
+
+class NotFoundCache:
+    """Keys that recently matched nothing, answered without SQL until they expire."""
+
+    def __init__(self, ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._keys: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        expires = self._keys.get(key)
+        if expires is None:
+            return False
+        if expires > time.monotonic():
+            return True
+        with self._lock:
+            self._keys.pop(key, None)
+        return False
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self._keys[key] = time.monotonic() + self.ttl
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+class SharedNotFoundCache:
+    """
+    NotFoundCache shared by every worker: an mmap'd file of <Q d> (key hash,
+    expiry as wall-clock time) slots, so a code created by one worker's checkout
+    is dropped for all of them. A colliding key just evicts the slot (a miss
+    falls back to SQL). Locking as in SharedTokenBuckets.
+    """
+    SLOT = struct.Struct("<Qd")
+
+    def __init__(self, path: str, ttl: float, slots: int = 1 << 16):
+        import fcntl
+        self._fcntl = fcntl
+        self.ttl = ttl
+        self.slots = slots
+        size = self.SLOT.size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _slot(self, key: str) -> tuple[int, int]:
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") | 1  # 0 = empty
+        return h, self.SLOT.size * (h % self.slots)
+
+    def _locked(self, off: int, fn):
+        with self._lock:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.SLOT.size, off)
+            try:
+                return fn()
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.SLOT.size, off)
+
+    def __contains__(self, key: str) -> bool:
+        h, off = self._slot(key)
+        held, expires = self._locked(off, lambda: self.SLOT.unpack_from(self._map, off))
+        return held == h and expires > time.time()
+
+    def add(self, key: str) -> None:
+        h, off = self._slot(key)
+        self._locked(off, lambda: self.SLOT.pack_into(self._map, off, h, time.time() + self.ttl))
+
+    def discard(self, key: str) -> None:
+        h, off = self._slot(key)
+
+        def clear():
+            if self.SLOT.unpack_from(self._map, off)[0] == h:
+                self.SLOT.pack_into(self._map, off, 0, 0.0)
+        self._locked(off, clear)
+
+
+def make_rate_store():
+    shared_dir = app.config["RATE_LIMIT_SHARED_DIR"]
+    if shared_dir:
+        os.makedirs(shared_dir, exist_ok=True)
+        return SharedTokenBuckets(os.path.join(shared_dir, "rate-buckets.bin"))
+    return TokenBuckets(app.config["RATE_LIMIT_MAX_KEYS"])
+
+
+def make_not_found_cache():
+    ttl, shared_dir = app.config["NOT_FOUND_CACHE_SECONDS"], app.config["RATE_LIMIT_SHARED_DIR"]
+    if shared_dir:
+        os.makedirs(shared_dir, exist_ok=True)
+        return SharedNotFoundCache(os.path.join(shared_dir, "not-found.bin"), ttl)
+    return NotFoundCache(ttl, app.config["RATE_LIMIT_MAX_KEYS"])
+
+
+rate_store = make_rate_store()
+unknown_tracking_codes = make_not_found_cache()
+TRACKING_CODE_RE = re.compile(r"[A-Z0-9]{6,12}")
+metrics.counter("fa_rate_limited_total", "Public lookups refused by a rate-limit bucket.")
+metrics.counter("fa_lookup_short_circuits_total", "Tracking lookups answered without SQL (malformed or cached not-found).")
+
+
+def rate_limit(*checks: tuple[str, str]) -> float:
+    """
+    Takes a token from each (bucket, key) in RATE_LIMITS.
+    Returns 0 when the request may proceed, otherwise seconds until it may retry.
+    """
+    if not app.config["RATE_LIMIT_ENABLED"]:
+        return 0.0
+    now = time.time()
+    for bucket, key in checks:
+        per_minute, burst = app.config["RATE_LIMITS"][bucket]
+        wait = rate_store.take(f"{bucket}:{key}", per_minute / 60.0, burst, now)
+        if wait:
+            metrics.inc("fa_rate_limited_total", (("bucket", bucket),))
+            return wait
+    return 0.0
+
+
+def too_many_requests(template: str, wait: float, **context):
+    flash("Too many lookups. Please wait a moment and try again.", "error")
+    return render_template(template, **context), 429, {"Retry-After": str(math.ceil(wait))}
+
+
 @app.before_request
 def load_user():
     uid = session.get("user_id")
@@ -227,7 +2176,112 @@ def load_user():
 
 @app.context_processor
 def inject_globals():
-    return dict(money_str=money_str)
+    return dict(
+        money_str=money_str,
+        cents_str=cents_str,
+        order_total_cents=order_total_cents,
+        idempotency_key=new_idempotency_key,
+    )
+
+
+# -------------------- PASSWORDS --------------------
+# The pool uses "spawn" (safe next to the job runner's threads, and the only
+# option on Windows), so scripts that import app and log users in must keep
+# their top-level code under `if __name__ == "__main__":`.
+class PasswordBusy(RuntimeError):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self):
+        self._pool: ProcessPoolExecutor | None = None
+        self._slots: threading.BoundedSemaphore | None = None
+        self._lock = threading.Lock()
+        self._prefixes: dict[str, str] = {}
+        self._verified: OrderedDict[bytes, float] = OrderedDict()
+        self._cache_key = secrets.token_bytes(32)  # per process: cache entries never leave memory
+
+    def _submit(self, fn, *args) -> Future:
+        if not app.config["PASSWORD_WORKERS"]:
+            fut = Future()
+            fut.set_result(fn(*args))
+            return fut
+        with self._lock:
+            if self._pool is None:
+                self._slots = threading.BoundedSemaphore(app.config["PASSWORD_MAX_PENDING"])
+                self._pool = ProcessPoolExecutor(app.config["PASSWORD_WORKERS"],
+                                                 mp_context=multiprocessing.get_context("spawn"))
+                atexit.register(self.shutdown)
+        if not self._slots.acquire(timeout=app.config["PASSWORD_WAIT_SECONDS"]):
+            raise PasswordBusy("Too many sign-ins right now. Please try again in a moment.")
+        try:
+            fut = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        fut.add_done_callback(lambda _: self._slots.release())
+        return fut
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+    def hash(self, password: str) -> str:
+        return self.hash_many([password])[0]
+
+    def hash_many(self, passwords: list[str]) -> list[str]:
+        """Hashes in parallel across the pool."""
+        started = time.perf_counter()
+        futures = [self._submit(generate_password_hash, pw, app.config["PASSWORD_METHOD"]) for pw in passwords]
+        hashes = [f.result() for f in futures]
+        metrics.observe("fa_password_hash_seconds", (("op", "hash"),), time.perf_counter() - started)
+        return hashes
+
+    def needs_rehash(self, stored: str) -> bool:
+        method = app.config["PASSWORD_METHOD"]
+        if method not in self._prefixes:
+            # Werkzeug expands defaults ("scrypt" -> "scrypt:32768:8:1"); learn the stored form once
+            self._prefixes[method] = self._submit(generate_password_hash, "", method).result().split("$", 1)[0]
+        return stored.split("$", 1)[0] != self._prefixes[method]
+
+    def _token(self, user_id: int, stored: str, password: str) -> bytes:
+        # Binds the entry to the stored hash, so a password change invalidates it
+        return hmac.new(self._cache_key, f"{user_id}\0{stored}\0{password}".encode(), hashlib.sha256).digest()
+
+    def verify(self, user: User, password: str) -> bool:
+        """
+        Checks `password` for `user`. On success, upgrades a hash made with other
+        parameters (user.password_hash is changed; the caller commits).
+        """
+        ttl = app.config["PASSWORD_CACHE_SECONDS"]
+        token = self._token(user.user_id, user.password_hash, password)
+        expires = self._verified.get(token)
+        if expires is not None and expires > time.monotonic():
+            metrics.inc("fa_logins_checked_total", (("result", "cached"),))
+            return True
+
+        started = time.perf_counter()
+        ok = self._submit(check_password_hash, user.password_hash, password).result()
+        metrics.observe("fa_password_hash_seconds", (("op", "verify"),), time.perf_counter() - started)
+        metrics.inc("fa_logins_checked_total", (("result", "ok" if ok else "failed"),))
+        if not ok:
+            return False
+
+        if self.needs_rehash(user.password_hash):
+            user.password_hash = self.hash(password)
+        if ttl:
+            with self._lock:
+                self._verified[self._token(user.user_id, user.password_hash, password)] = time.monotonic() + ttl
+                if len(self._verified) > app.config["PASSWORD_CACHE_MAX"]:
+                    self._verified.popitem(last=False)
+        return True
+
+
+passwords = PasswordHasher()
+metrics.counter("fa_logins_checked_total", "Password checks by result (ok/failed/cached).")
+metrics.histogram("fa_password_hash_seconds", "Password hash/verify time including pool wait.", LATENCY_BUCKETS)
 
 
 # -------------------- SEED DATA --------------------
@@ -235,13 +2289,22 @@ def seed_if_empty():
     if User.query.count() > 0:
         return
 
+    # Seed accounts share a password per role: hash each distinct one once, in parallel
+    distinct = ["admin123", "owner123", "agent123", "cust123"]
+    hashes = dict(zip(distinct, passwords.hash_many(distinct)))
+
+    def password_hash(pw: str) -> str:
+        if pw not in hashes:
+            hashes[pw] = passwords.hash(pw)
+        return hashes[pw]
+
     # Admin
     admin = User(
         full_name="System Admin",
         email="admin@fa.local",
         phone_number="0300-0000000",
         type="Admin",
-        password_hash=generate_password_hash("admin123"),
+        password_hash=password_hash("admin123"),
         address="HQ",
     )
     db.session.add(admin)
@@ -255,7 +2318,7 @@ def seed_if_empty():
             email=f"owner{i}@fa.local",
             phone_number=f"0311-000000{i}",
             type="Restaurant Owner",
-            password_hash=generate_password_hash("owner123"),
+            password_hash=password_hash("owner123"),
             address="City Center",
         )
         owners.append(o)
@@ -264,6 +2327,7 @@ def seed_if_empty():
 
     # Restaurants (>=5 active)
     rest_names = ["Karachi Bites", "Lahore Grill", "Islamabad Cafe", "Peshawar Tikka", "Quetta Kitchen"]
+    rest_coords = [(24.8607, 67.0011), (31.5204, 74.3587), (33.6844, 73.0479), (34.0151, 71.5249), (30.1798, 66.9750)]
     restaurants = []
     for i in range(5):
         r = Restaurant(
@@ -271,6 +2335,8 @@ def seed_if_empty():
             name=rest_names[i],
             address=f"Main Road Block {i+1}",
             status="Active",
+            latitude=rest_coords[i][0],
+            longitude=rest_coords[i][1],
         )
         restaurants.append(r)
         db.session.add(r)
@@ -301,7 +2367,7 @@ def seed_if_empty():
             email=f"agent{i}@fa.local",
             phone_number=f"0322-00000{i:02d}",
             type="Delivery Agent",
-            password_hash=generate_password_hash("agent123"),
+            password_hash=password_hash("agent123"),
             address="Near Hub",
         ))
 
@@ -312,7 +2378,7 @@ def seed_if_empty():
             email=f"cust{i}@fa.local",
             phone_number=f"0333-000000{i}",
             type="Customer",
-            password_hash=generate_password_hash("cust123"),
+            password_hash=password_hash("cust123"),
             address="Some Street",
         ))
 
@@ -352,9 +2418,16 @@ def login():
         password = request.form.get("password") or ""
 
         u = User.query.filter(func.lower(User.email) == email).first()
-        if not u or not check_password_hash(u.password_hash, password):
+        try:
+            ok = u is not None and passwords.verify(u, password)
+        except PasswordBusy as e:
+            flash(str(e), "error")
+            return render_template("login.html"), 503
+        if not ok:
             flash("Invalid email or password.", "error")
             return render_template("login.html")
+        if db.session.is_modified(u):
+            db.session.commit()  # password hash upgraded to the current PASSWORD_METHOD
 
         # Staff-only login
         if u.type not in ("Admin", "Delivery Agent", "Restaurant Owner"):
@@ -373,32 +2446,251 @@ def logout():
     return redirect(url_for("login"))
 
 
-# -------------------- PUBLIC (Customer-free browsing + cart + checkout) --------------------
+# -------------------- CART STORE --------------------
+# The session cookie only carries "cart_id"; cart contents live server-side.
+def empty_cart() -> dict:
+    return {"restaurant_id": None, "items": {}}
+
+
+class CartStore(ABC):
+    """
+    Carts are {"restaurant_id": int | None, "items": {str(menu_id): qty}}.
+    Idle carts expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, cart_id: str) -> dict:
+        ...
+
+    @abstractmethod
+    def add(self, cart_id: str, restaurant_id: int, menu_id: int, qty: int) -> None:
+        """Atomically adds qty of an item; switching restaurant starts a new cart."""
+
+    @abstractmethod
+    def replace(self, cart_id: str, cart: dict) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self, cart_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        ...
+
+
+class MemoryCartStore(CartStore):
+    """Per-process LRU; evicts the least recently used cart past max_entries."""
+
+    def __init__(self, ttl: int, max_entries: int):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._carts: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, cart_id: str) -> dict | None:
+        entry = self._carts.get(cart_id)
+        if entry is None:
+            return None
+        touched, cart = entry
+        if time.monotonic() - touched > self.ttl:
+            del self._carts[cart_id]
+            return None
+        return cart
+
+    def _put(self, cart_id: str, cart: dict) -> None:
+        self._carts[cart_id] = (time.monotonic(), cart)
+        self._carts.move_to_end(cart_id)
+        while len(self._carts) > self.max_entries:
+            self._carts.popitem(last=False)
+
+    def get(self, cart_id):
+        with self._lock:
+            cart = self._live(cart_id)
+            if cart is None:
+                return empty_cart()
+            self._carts.move_to_end(cart_id)
+            return {"restaurant_id": cart["restaurant_id"], "items": dict(cart["items"])}
+
+    def add(self, cart_id, restaurant_id, menu_id, qty):
+        with self._lock:
+            cart = self._live(cart_id)
+            if cart is None or cart["restaurant_id"] != restaurant_id:
+                cart = {"restaurant_id": restaurant_id, "items": {}}
+            key = str(menu_id)
+            cart["items"][key] = cart["items"].get(key, 0) + qty
+            self._put(cart_id, cart)
+        self.purge_expired()
+
+    def replace(self, cart_id, cart):
+        with self._lock:
+            if cart["items"]:
+                self._put(cart_id, {"restaurant_id": cart["restaurant_id"], "items": dict(cart["items"])})
+            else:
+                self._carts.pop(cart_id, None)
+        self.purge_expired()
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+
+    def purge_expired(self):
+        # Entries are kept in touch order, so expired carts are all at the front
+        cutoff = time.monotonic() - self.ttl
+        n = 0
+        with self._lock:
+            while self._carts:
+                cid, (touched, _) = next(iter(self._carts.items()))
+                if touched >= cutoff:
+                    break
+                del self._carts[cid]
+                n += 1
+        return n
+
+
+class SqlCartStore(CartStore):
+    """Carts in the carts/cart_items tables, so every worker sees the same cart."""
+
+    def _cutoff(self) -> datetime:
+        return now_utc() - timedelta(seconds=self.ttl)
+
+    def get(self, cart_id):
+        c = db.session.get(Cart, cart_id)
+        if not c or c.updated_at < self._cutoff():
+            return empty_cart()
+        return {"restaurant_id": c.restaurant_id, "items": {str(l.menu_item_id): l.quantity for l in c.lines}}
+
+    def _touch(self, cart_id: str, restaurant_id: int | None) -> None:
+        c = db.session.get(Cart, cart_id)
+        if not c:
+            db.session.add(Cart(cart_id=cart_id, restaurant_id=restaurant_id, updated_at=now_utc()))
+            db.session.flush()
+            return
+        if c.restaurant_id != restaurant_id or c.updated_at < self._cutoff():
+            db.session.execute(db.delete(CartLine).where(CartLine.cart_id == cart_id))
+            c.restaurant_id = restaurant_id
+        c.updated_at = now_utc()
+
+    def add(self, cart_id, restaurant_id, menu_id, qty):
+        for _ in range(2):
+            try:
+                self._touch(cart_id, restaurant_id)
+                res = db.session.execute(
+                    db.update(CartLine)
+                    .where(CartLine.cart_id == cart_id, CartLine.menu_item_id == menu_id)
+                    .values(quantity=CartLine.quantity + qty)
+                )
+                if res.rowcount == 0:
+                    db.session.add(CartLine(cart_id=cart_id, menu_item_id=menu_id, quantity=qty))
+                db.session.commit()
+                break
+            except IntegrityError:
+                # A concurrent add created the same row first; retry as an increment
+                db.session.rollback()
+
+    def replace(self, cart_id, cart):
+        if not cart["items"]:
+            self.clear(cart_id)
+            return
+        self._touch(cart_id, cart["restaurant_id"])
+        db.session.execute(db.delete(CartLine).where(CartLine.cart_id == cart_id))
+        db.session.add_all([
+            CartLine(cart_id=cart_id, menu_item_id=int(mid), quantity=int(qty))
+            for mid, qty in cart["items"].items()
+        ])
+        db.session.commit()
+
+    def clear(self, cart_id):
+        db.session.execute(db.delete(CartLine).where(CartLine.cart_id == cart_id))
+        db.session.execute(db.delete(Cart).where(Cart.cart_id == cart_id))
+        db.session.commit()
+
+    def purge_expired(self):
+        stale = db.select(Cart.cart_id).where(Cart.updated_at < self._cutoff()).scalar_subquery()
+        db.session.execute(db.delete(CartLine).where(CartLine.cart_id.in_(stale)))
+        n = db.session.execute(db.delete(Cart).where(Cart.updated_at < self._cutoff())).rowcount
+        db.session.commit()
+        return n
+
+
+def make_cart_store() -> CartStore:
+    ttl = app.config["CART_TTL_SECONDS"]
+    if app.config["CART_BACKEND"] == "sql":
+        return SqlCartStore(ttl)
+    return MemoryCartStore(ttl, app.config["CART_MAX_ENTRIES"])
+
+
+cart_store = make_cart_store()
+
+
+@job("purge_carts", every=10 * 60)
+def purge_carts(payload: dict) -> None:
+    # Memory carts are swept in-process on every write; only the shared table needs a job
+    if isinstance(cart_store, SqlCartStore):
+        cart_store.purge_expired()
+
+
+def cart_id(create: bool = False) -> str | None:
+    cid = session.get("cart_id")
+    if not cid and create:
+        cid = secrets.token_hex(16)
+        session["cart_id"] = cid
+    return cid
+
+
 def get_cart():
-    return session.get("cart", {"restaurant_id": None, "items": {}})
+    cid = cart_id()
+    return cart_store.get(cid) if cid else empty_cart()
 
 
 def save_cart(cart):
-    session["cart"] = cart
+    cart_store.replace(cart_id(create=True), cart)
+
+
+def clear_cart():
+    cid = cart_id()
+    if cid:
+        cart_store.clear(cid)
 
 
+# -------------------- PUBLIC (Customer-free browsing + cart + checkout) --------------------
+
 @app.route("/restaurants")
 def public_restaurants():
-    # Filters: q, active_only, status
+    # Filters: q, active_only, status; lat+lng switch to the nearest open restaurants
     q = (request.args.get("q") or "").strip()
     status = (request.args.get("status") or "").strip()  # Active/Inactive/Busy
     active_only = (request.args.get("active_only") or "1") == "1"
 
+    try:
+        here = parse_coords(request.args.get("lat"), request.args.get("lng"))
+    except ValueError as e:
+        flash(str(e), "error")
+        here = None
+    if here:
+        radius = app.config["GEO_DELIVERY_RADIUS_KM"]
+        near = geo.nearest(*here, app.config["GEO_NEAR_LIMIT"], radius, name_contains=q)
+        by_id = {r.restaurant_id: r for r in Restaurant.query.filter(
+            Restaurant.restaurant_id.in_([rid for _, rid in near]))}
+        restaurants = [by_id[rid] for _, rid in near if rid in by_id]
+        distances = {rid: d for d, rid in near}
+        return render_template("customer/restaurants.html", restaurants=restaurants, q=q, active_only=True,
+                               status="", here=here, distances=distances, radius=radius)
+
     query = Restaurant.query
     if active_only:
-        query = query.filter_by(status="Active")
+        # Busy restaurants are open (just slower); they stay listed with a Busy badge
+        query = query.filter(Restaurant.status.in_(OPEN_STATUSES))
     elif status in ("Active", "Inactive", "Busy"):
         query = query.filter_by(status=status)
     if q:
         query = query.filter(Restaurant.name.like(f"%{q}%"))
 
     restaurants = query.order_by(Restaurant.restaurant_id.desc()).all()
-    # Busy badges are driven by restaurant.status == "Busy"
+    # Busy badges are driven by restaurant.status == "Busy" (set by CapacityTracker or an admin)
     return render_template("customer/restaurants.html", restaurants=restaurants, q=q, active_only=active_only, status=status)
 
 
@@ -413,32 +2705,64 @@ def public_restaurant_menu(rid: int):
     only_available = (request.args.get("only_available") or "1") == "1"
     q = (request.args.get("q") or "").strip()
 
-    query = MenuItem.query.filter_by(restaurant_id=r.restaurant_id)
+    if request.headers.get("X-Menu-Shell") == "1":
+        # The service worker fills the list from its synced copy of the menu (static/sw.js)
+        resp = app.make_response(render_template(
+            "customer/restaurant_menu.html", r=r, items=[], shell=True,
+            category=category, only_available=only_available, q=q,
+        ))
+        resp.vary.add("X-Menu-Shell")
+        return resp
+
+    snap = menu_snapshot(r.restaurant_id)
+    items = snap.items() if snap else []
     if only_available:
-        query = query.filter_by(availability=True)
+        items = [m for m in items if m.availability]
     if category in ("Food", "Drink"):
-        query = query.filter_by(category=category)
+        items = [m for m in items if m.category == category]
     if q:
-        query = query.filter(MenuItem.name.like(f"%{q}%"))
+        needle = q.casefold()
+        items = [m for m in items if needle in m.name.casefold()]
 
-    items = query.order_by(MenuItem.menu_id.desc()).all()
+    items.reverse()  # newest first
     cart = get_cart()
     return render_template("customer/restaurant_menu.html", r=r, items=items, cart=cart, category=category, only_available=only_available, q=q)
 
 
+@app.route("/api/menu/<int:rid>")
+def api_menu(rid: int):
+    """
+    Menu delta for offline clients: {"restaurant", "version", "full", "items", "deleted"}.
+    Pass the last "version" back as ?since= to receive only what changed after it.
+    """
+    delta = menu_delta(rid, request.args.get("since", 0, type=int))
+    if delta is None:
+        abort(404)
+    return Response(json.dumps(delta), mimetype="application/json", headers={"Cache-Control": "no-store"})
+
+
+@app.route("/sw.js")
+def service_worker():
+    # Served from the root so its scope covers every page, and revalidated on each load
+    resp = app.send_static_file("sw.js")
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
 @app.route("/cart")
 def public_cart():
     cart = get_cart()
     rest = Restaurant.query.get(cart["restaurant_id"]) if cart["restaurant_id"] else None
     lines = []
-    total = Decimal("0.00")
+    total = 0  # cents
 
     if rest:
+        snap = menu_snapshot(rest.restaurant_id)
         for mid_str, qty in cart["items"].items():
-            mi = MenuItem.query.get(int(mid_str))
+            mi = snap.get(int(mid_str)) if snap else None
             if not mi:
                 continue
-            line_total = Decimal(str(mi.price)) * Decimal(str(qty))
+            line_total = mi.price_cents * qty
             total += line_total
             lines.append((mi, qty, line_total))
 
@@ -452,25 +2776,21 @@ def public_cart_add():
         mid = int(request.form["menu_id"])
         qty = int(request.form.get("qty", "1"))
 
-        r = Restaurant.query.get_or_404(rid)
-        if r.status == "Inactive":
+        snap = menu_snapshot(rid)
+        if not snap:
+            raise ValueError("Restaurant not found.")
+        if snap.status == "Inactive":
             raise ValueError("Restaurant inactive.")
-        mi = MenuItem.query.get_or_404(mid)
-        if mi.restaurant_id != rid:
+        mi = snap.get(mid)
+        if not mi:
             raise ValueError("Invalid item for this restaurant.")
         if not mi.availability:
             raise ValueError("Item unavailable.")
         if qty <= 0:
             raise ValueError("Qty must be >= 1")
 
-        cart = get_cart()
-        # Single-restaurant cart rule
-        if cart["restaurant_id"] and cart["restaurant_id"] != rid:
-            cart = {"restaurant_id": rid, "items": {}}
-
-        cart["restaurant_id"] = rid
-        cart["items"][str(mid)] = cart["items"].get(str(mid), 0) + qty
-        save_cart(cart)
+        # Single-restaurant cart rule is enforced by the store
+        cart_store.add(cart_id(create=True), rid, mid, qty)
 
         flash("Added to cart.", "ok")
     except Exception as e:
@@ -487,6 +2807,8 @@ def public_cart_update():
         if not k.startswith("qty_"):
             continue
         mid = k.replace("qty_", "").strip()
+        if not mid.isdigit():
+            continue
         try:
             qty = int(v)
         except Exception:
@@ -495,7 +2817,7 @@ def public_cart_update():
             new_items[mid] = qty
     cart["items"] = new_items
     if not cart["items"]:
-        cart = {"restaurant_id": None, "items": {}}
+        cart = empty_cart()
     save_cart(cart)
     flash("Cart updated.", "ok")
     return redirect(url_for("public_cart"))
@@ -503,7 +2825,7 @@ def public_cart_update():
 
 @app.route("/cart/clear", methods=["POST"])
 def public_cart_clear():
-    session["cart"] = {"restaurant_id": None, "items": {}}
+    clear_cart()
     flash("Cart cleared.", "ok")
     return redirect(url_for("public_cart"))
 
@@ -513,14 +2835,40 @@ def public_checkout():
     """
     Guest checkout: collects name, phone, address, payment_method, delivery_instructions.
     Generates tracking_code and timeline event.
+    Resubmits carrying the same idempotency_key return the first order's tracking page.
+    Checkout is refused (or waits, see CAPACITY_QUEUE_SECONDS) while the kitchen is full.
     """
+    rid = get_cart()["restaurant_id"]
+    if rid:
+        # Before the idempotency claim, so a queued checkout holds no write lock while it waits
+        try:
+            admit_checkout(rid)
+        except AtCapacity as e:
+            replay = idempotent_replay("checkout")
+            db.session.rollback()
+            if replay:
+                metrics.inc("fa_checkouts_total", (("result", "replayed"),))
+                clear_cart()
+                return redirect(replay)
+            metrics.inc("fa_checkouts_total", (("result", "at_capacity"),))
+            flash(str(e), "error")
+            return redirect(url_for("public_cart"))
+
+    replay = idempotent_replay("checkout")
+    if replay:
+        metrics.inc("fa_checkouts_total", (("result", "replayed"),))
+        clear_cart()
+        return redirect(replay)
+
     try:
         cart = get_cart()
         if not cart["restaurant_id"] or not cart["items"]:
             raise ValueError("Cart is empty.")
 
-        r = Restaurant.query.get_or_404(cart["restaurant_id"])
-        if r.status == "Inactive":
+        snap = menu_snapshot(cart["restaurant_id"], current=True)  # prices are charged from it
+        if not snap:
+            raise ValueError("Restaurant not found.")
+        if snap.status == "Inactive":
             raise ValueError("Restaurant inactive.")
 
         customer_name = (request.form.get("customer_name") or "").strip()
@@ -531,25 +2879,36 @@ def public_checkout():
 
         if not customer_name or not customer_phone or not customer_address:
             raise ValueError("Name, phone, and address are required.")
+        customer_phone_key = normalize_phone(customer_phone)
+        if not customer_phone_key:
+            raise ValueError("Enter a valid phone number.")
+        drop = parse_coords(request.form.get("customer_latitude"), request.form.get("customer_longitude"))
+        kitchen = geo.location(snap.restaurant_id) if drop else None
+        if kitchen and distance_km(*kitchen, *drop) > app.config["GEO_DELIVERY_RADIUS_KM"]:
+            raise ValueError(f"This restaurant does not deliver to your location "
+                             f"(over {app.config['GEO_DELIVERY_RADIUS_KM']:g} km away).")
 
         order = Order(
             user_id=g.user.user_id if g.user else None,  # if staff places an order
-            restaurant_id=r.restaurant_id,
+            restaurant_id=snap.restaurant_id,
             status="Placed",
             payment_method=payment_method,
             delivery_instructions=delivery_instructions,
             tracking_code=generate_tracking_code(),
             customer_name=customer_name,
             customer_phone=customer_phone,
+            customer_phone_key=customer_phone_key,
             customer_address=customer_address,
+            customer_latitude=drop[0] if drop else None,
+            customer_longitude=drop[1] if drop else None,
         )
         db.session.add(order)
         db.session.flush()
 
         added = 0
         for mid_str, qty in cart["items"].items():
-            mi = MenuItem.query.get(int(mid_str))
-            if not mi or mi.restaurant_id != r.restaurant_id or not mi.availability:
+            mi = snap.get(int(mid_str))
+            if not mi or not mi.availability:
                 continue
             db.session.add(OrderItem(
                 order_id=order.order_id,
@@ -563,14 +2922,22 @@ def public_checkout():
             raise ValueError("No valid items to checkout.")
 
         log_history(order.order_id, "Placed", g.user.user_id if g.user else None, "Order placed (guest/public)")
+        emit_event("placed", order, items=added)
+        tracking_code = order.tracking_code
+        unknown_tracking_codes.discard(tracking_code)
+        track_url = remember_idempotent_result(url_for("public_track", tracking_code=tracking_code))
+        capacity.settle(snap.restaurant_id)  # a Busy flip is queued with the order, not written here
         db.session.commit()
+        confirm_checkout()
 
-        session["cart"] = {"restaurant_id": None, "items": {}}
-        flash(f"Order placed! Tracking Code: {order.tracking_code}", "ok")
-        return redirect(url_for("public_track", tracking_code=order.tracking_code))
+        metrics.inc("fa_checkouts_total", (("result", "placed"),))
+        clear_cart()
+        flash(f"Order placed! Tracking Code: {tracking_code}", "ok")
+        return redirect(track_url)
 
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
+        metrics.inc("fa_checkouts_total", (("result", "failed"),))
         flash(str(e), "error")
         return redirect(url_for("public_cart"))
 
@@ -586,12 +2953,23 @@ def public_track():
         flash("Enter a valid tracking code.", "error")
         return render_template("customer/track.html", order=None)
 
+    wait = rate_limit(("track-ip", request.remote_addr), ("track-code", tracking_code))
+    if wait:
+        return too_many_requests("customer/track.html", wait, order=None)
+
+    # Codes that cannot exist, or were just looked up in vain, never reach the database
+    if not TRACKING_CODE_RE.fullmatch(tracking_code) or tracking_code in unknown_tracking_codes:
+        metrics.inc("fa_lookup_short_circuits_total")
+        flash("Order not found for this tracking code.", "error")
+        return render_template("customer/track.html", order=None)
+
     order = Order.query.filter(func.upper(Order.tracking_code) == tracking_code).first()
     if not order:
+        unknown_tracking_codes.add(tracking_code)
         flash("Order not found for this tracking code.", "error")
         return render_template("customer/track.html", order=None)
 
-    total = calc_order_total(order)
+    total = order_total_cents(order)
     eta_label, eta_detail = eta_for_order(order)
 
     last_loc = None
@@ -611,6 +2989,36 @@ def public_track():
     )
 
 
+def orders_for_phone(phone_key: str, limit: int = 100):
+    """
+    One round-trip for the My Orders list: the newest orders for a phone key
+    (served by idx_orders_phone_key) joined with restaurant name and item total.
+    """
+    latest = (
+        db.select(Order.order_id)
+        .where(Order.customer_phone_key == phone_key)
+        .order_by(Order.order_id.desc())
+        .limit(limit)
+        .subquery()
+    )
+    total = func.coalesce(func.sum(OrderItem.quantity * OrderItem.price_at_purchase), 0)
+    stmt = (
+        db.select(
+            Order.order_id,
+            Order.status,
+            Order.tracking_code,
+            Restaurant.name.label("restaurant_name"),
+            total.label("total"),
+        )
+        .join(latest, latest.c.order_id == Order.order_id)
+        .join(Restaurant, Restaurant.restaurant_id == Order.restaurant_id)
+        .outerjoin(OrderItem, OrderItem.order_id == Order.order_id)
+        .group_by(Order.order_id, Order.status, Order.tracking_code, Restaurant.name)
+        .order_by(Order.order_id.desc())
+    )
+    return db.session.execute(stmt).all()
+
+
 @app.route("/my-orders", methods=["GET", "POST"])
 def public_my_orders():
     """
@@ -620,14 +3028,20 @@ def public_my_orders():
     orders = []
     if request.method == "POST":
         phone = (request.form.get("phone_number") or "").strip()
+        phone_key = normalize_phone(phone)
         if not phone:
             flash("Enter phone number.", "error")
+        elif not phone_key:
+            flash("Enter a valid phone number.", "error")
         else:
-            orders = Order.query.filter_by(customer_phone=phone).order_by(Order.order_id.desc()).limit(100).all()
+            wait = rate_limit(("lookup-ip", request.remote_addr), ("lookup-phone", phone_key))
+            if wait:
+                return too_many_requests("customer/orders.html", wait, orders=[], phone=phone)
+            orders = orders_for_phone(phone_key)
             if not orders:
                 flash("No orders found for this phone.", "error")
 
-    return render_template("customer/orders.html", orders=orders, calc_order_total=calc_order_total, phone=phone)
+    return render_template("customer/orders.html", orders=orders, phone=phone)
 
 
 @app.route("/reorder/<int:oid>", methods=["POST"])
@@ -641,9 +3055,10 @@ def public_reorder(oid: int):
         flash("Restaurant inactive.", "error")
         return redirect(url_for("public_restaurants"))
 
+    snap = menu_snapshot(r.restaurant_id)
     cart = {"restaurant_id": r.restaurant_id, "items": {}}
     for it in prev.items:
-        mi = MenuItem.query.get(it.menu_item_id)
+        mi = snap.get(it.menu_item_id) if snap else None
         if not mi or not mi.availability:
             continue
         cart["items"][str(mi.menu_id)] = cart["items"].get(str(mi.menu_id), 0) + it.quantity
@@ -688,11 +3103,13 @@ def admin_restaurants():
                 status=request.form.get("status", "Active"),
                 owner_id=int(request.form["owner_id"]) if request.form.get("owner_id") else None
             )
+            r.latitude, r.longitude = parse_location(request.form.get("location")) or (None, None)
             db.session.add(r)
             db.session.commit()
+            geo.update(r)
             flash("Restaurant created.", "ok")
         except Exception as e:
-            db.session.rollback()
+            rollback(e)
             flash(str(e), "error")
         return redirect(url_for("admin_restaurants"))
 
@@ -706,7 +3123,8 @@ def admin_restaurants():
         query = query.filter(Restaurant.name.like(f"%{q}%"))
 
     restaurants = query.order_by(Restaurant.restaurant_id.desc()).all()
-    return render_template("admin/restaurants.html", restaurants=restaurants, owners=owners, q=q, status=status)
+    return render_template("admin/restaurants.html", restaurants=restaurants, owners=owners, q=q, status=status,
+                           default_limit=app.config["CAPACITY_DEFAULT_LIMIT"])
 
 
 @app.route("/admin/restaurants/<int:rid>/update", methods=["POST"])
@@ -716,12 +3134,29 @@ def admin_restaurant_update(rid: int):
         r = Restaurant.query.get_or_404(rid)
         r.name = request.form["name"].strip()
         r.address = request.form["address"].strip()
-        r.status = request.form.get("status", "Active")
+        status = request.form.get("status", "Active")
+        # An auto-Busy restaurant is listed as "Busy": saving it unchanged (e.g. an
+        # address edit) keeps the tracker in charge. A different status is the
+        # admin's choice and is never lifted automatically.
+        status_changed = status != r.status
+        if status_changed:
+            r.status, r.auto_busy = status, False
         r.owner_id = int(request.form["owner_id"]) if request.form.get("owner_id") else None
+        limit_raw = (request.form.get("max_in_flight") or "").strip()
+        r.max_in_flight = int(limit_raw) if limit_raw else None
+        if r.max_in_flight is not None and r.max_in_flight < 0:
+            raise ValueError("Max in-flight orders cannot be negative.")
+        r.latitude, r.longitude = parse_location(request.form.get("location")) or (None, None)
         db.session.commit()
+        menu_cache.invalidate(rid)
+        # Re-read limits and auto-Busy flags: the tracker must not undo the admin's status
+        if status_changed:
+            capacity.forget_auto_busy(rid)
+        capacity.resync(force=True)
+        geo.update(r)
         flash("Restaurant updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
     return redirect(url_for("admin_restaurants"))
 
@@ -733,9 +3168,11 @@ def admin_restaurant_delete(rid: int):
         r = Restaurant.query.get_or_404(rid)
         db.session.delete(r)
         db.session.commit()
+        menu_cache.invalidate(rid)
+        geo.discard(rid)
         flash("Restaurant deleted.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(f"Cannot delete (maybe menu/orders exist): {e}", "error")
     return redirect(url_for("admin_restaurants"))
 
@@ -750,14 +3187,14 @@ def admin_agents():
                 email=request.form["email"].strip().lower(),
                 phone_number=request.form["phone_number"].strip(),
                 type="Delivery Agent",
-                password_hash=generate_password_hash(request.form["password"]),
+                password_hash=passwords.hash(request.form["password"]),
                 address=(request.form.get("address") or "").strip() or None
             )
             db.session.add(u)
             db.session.commit()
             flash("Delivery agent created.", "ok")
         except Exception as e:
-            db.session.rollback()
+            rollback(e)
             flash(str(e), "error")
         return redirect(url_for("admin_agents"))
 
@@ -776,11 +3213,11 @@ def admin_agent_update(uid: int):
         u.phone_number = request.form["phone_number"].strip()
         u.address = (request.form.get("address") or "").strip() or None
         if (request.form.get("password") or "").strip():
-            u.password_hash = generate_password_hash(request.form["password"])
+            u.password_hash = passwords.hash(request.form["password"])
         db.session.commit()
         flash("Agent updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
     return redirect(url_for("admin_agents"))
 
@@ -796,7 +3233,7 @@ def admin_agent_delete(uid: int):
         db.session.commit()
         flash("Agent deleted.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(f"Cannot delete (maybe assigned deliveries exist): {e}", "error")
     return redirect(url_for("admin_agents"))
 
@@ -821,42 +3258,189 @@ def admin_orders():
         )
 
     orders = query.order_by(Order.order_id.desc()).limit(50).all()
-    agents = User.query.filter_by(type="Delivery Agent").order_by(User.user_id.desc()).all()
-    return render_template("admin/orders.html", orders=orders, agents=agents, status=status, q=q)
+    agents = db.session.execute(
+        db.select(User.user_id, User.full_name).where(User.type == "Delivery Agent").order_by(User.user_id.desc())
+    ).all()
+    # Rendered once as a <datalist>; rows look names up here instead of loading o.delivery.agent
+    agent_names = {a.user_id: a.full_name for a in agents}
+    return render_template("admin/orders.html", orders=orders, agents=agents, agent_names=agent_names,
+                           status=status, q=q)
 
 
-@app.route("/admin/orders/<int:oid>/assign", methods=["POST"])
+ASSIGNABLE_STATUSES = ("Placed", "Accepted", "Preparing", "Out for Delivery")
+
+
+def parse_drop_time(raw: str | None) -> datetime | None:
+    """'YYYY-MM-DD HH:MM[:SS]' or an HTML datetime-local value; blank means none."""
+    raw = (raw or "").strip()
+    return datetime.fromisoformat(raw) if raw else None
+
+
+def assign_deliveries(assignments: list[tuple[int, int, datetime | None]]) -> dict:
+    """
+    Assigns or reassigns (order_id, agent_id, expected_drop_at) in one transaction.
+    Validation is set-based (three SELECTs however many orders), then one
+    executemany INSERT for new assignments and one executemany UPDATE for changed
+    ones. Any invalid pair aborts the whole batch. Returns a report.
+    """
+    report = {"assigned": 0, "reassigned": 0, "unchanged": 0, "errors": []}
+    wanted: dict[int, tuple[int, datetime | None]] = {}
+    for oid, agent_id, expected in assignments:
+        if oid in wanted:
+            report["errors"].append(f"Order #{oid} appears twice.")
+        wanted[oid] = (agent_id, expected)
+    if not wanted:
+        report["errors"].append("No orders selected.")
+        return report
+
+    orders = {o.order_id: o for o in db.session.execute(
+        db.select(Order.order_id, Order.restaurant_id, Order.status).where(Order.order_id.in_(wanted))
+    ).all()}
+    agents = set(db.session.execute(
+        db.select(User.user_id).where(
+            User.user_id.in_({a for a, _ in wanted.values()}), User.type == "Delivery Agent"
+        )
+    ).scalars())
+    existing = {d.order_id: d for d in db.session.execute(
+        db.select(DeliveryAssignment.delivery_id, DeliveryAssignment.order_id,
+                  DeliveryAssignment.delivery_agent_id, DeliveryAssignment.expected_drop_at)
+        .where(DeliveryAssignment.order_id.in_(wanted))
+    ).all()}
+
+    inserts, updates, changed = [], [], []
+    for oid, (agent_id, expected) in wanted.items():
+        o = orders.get(oid)
+        if o is None:
+            report["errors"].append(f"Order #{oid} not found.")
+        elif o.status not in ASSIGNABLE_STATUSES:
+            report["errors"].append(f"Order #{oid} is {o.status}.")
+        elif agent_id not in agents:
+            report["errors"].append(f"User #{agent_id} (order #{oid}) is not a Delivery Agent.")
+        elif oid not in existing:
+            inserts.append({"order_id": oid, "delivery_agent_id": agent_id, "expected_drop_at": expected,
+                            "status": "Assigned", "assigned_at": now_utc()})
+            changed.append(oid)
+        elif (existing[oid].delivery_agent_id, existing[oid].expected_drop_at) != (agent_id, expected):
+            d = existing[oid]
+            updates.append({"delivery_id": d.delivery_id, "delivery_agent_id": agent_id, "expected_drop_at": expected})
+            changed.append(oid)
+        else:
+            report["unchanged"] += 1
+    if report["errors"] or not (inserts or updates):
+        return report
+
+    # Agent types were checked above for the whole batch; bulk statements skip the
+    # per-row before_insert/before_update hook (the MySQL trigger still applies).
+    if inserts:
+        db.session.execute(db.insert(DeliveryAssignment), inserts)
+    if updates:
+        db.session.execute(db.update(DeliveryAssignment), updates)
+    delivery_ids = dict(db.session.execute(
+        db.select(DeliveryAssignment.order_id, DeliveryAssignment.delivery_id)
+        .where(DeliveryAssignment.order_id.in_(changed))
+    ).all())
+    for oid in changed:
+        agent_id, expected = wanted[oid]
+        emit_event("assigned", orders[oid], delivery_id=delivery_ids[oid], agent_id=agent_id,
+                   expected_drop_at=expected.isoformat() if expected else None)
+    db.session.commit()
+    report["assigned"], report["reassigned"] = len(inserts), len(updates)
+    return report
+
+
+def _assign_summary(report: dict) -> None:
+    if report["errors"]:
+        flash("Nothing assigned: " + " ".join(report["errors"][:5]), "error")
+    else:
+        flash(f"{report['assigned']} assigned, {report['reassigned']} reassigned, "
+              f"{report['unchanged']} unchanged.", "ok")
+
+
+@app.route("/admin/orders/assign", methods=["POST"])
 @role_required("Admin")
-def admin_assign_delivery(oid: int):
+def admin_bulk_assign():
+    """
+    JSON: {"assignments": [{"order_id", "delivery_agent_id", "expected_drop_at"?}, ...]} -> report.
+    Form (admin/orders.html): checked order_id boxes take the bulk agent_all /
+    expected_all when set, else their row's agent_<oid> / expected_<oid>; a row's
+    Save button posts only=<oid> to submit just that row.
+    """
     try:
-        order = Order.query.get_or_404(oid)
-        agent_id = int(request.form["delivery_agent_id"])
-        exp_raw = (request.form.get("expected_drop_at") or "").strip()
-
-        agent = User.query.get_or_404(agent_id)
-        if agent.type != "Delivery Agent":
-            raise ValueError("Selected user is not a Delivery Agent.")
-
-        expected = None
-        if exp_raw:
-            expected = datetime.strptime(exp_raw, "%Y-%m-%d %H:%M:%S")
-
-        da = DeliveryAssignment.query.filter_by(order_id=order.order_id).first()
-        if not da:
-            da = DeliveryAssignment(order_id=order.order_id, delivery_agent_id=agent_id, expected_drop_at=expected)
-            db.session.add(da)
+        if request.is_json:
+            body = request.get_json(silent=True) or {}
+            pairs = [
+                (int(a["order_id"]), int(a["delivery_agent_id"]), parse_drop_time(a.get("expected_drop_at")))
+                for a in body.get("assignments", [])
+            ]
         else:
-            da.delivery_agent_id = agent_id
-            da.expected_drop_at = expected
+            f = request.form
+            single = f.get("only")
+            pairs = []
+            for oid in map(int, [single] if single else f.getlist("order_id")):
+                # The bulk bar wins over the (pre-filled) row inputs, except for a single-row Save
+                agent_raw = f.get(f"agent_{oid}") if single else (f.get("agent_all") or f.get(f"agent_{oid}"))
+                expected_raw = f.get(f"expected_{oid}") if single else (f.get("expected_all") or f.get(f"expected_{oid}"))
+                if not (agent_raw or "").strip():
+                    raise ValueError(f"Choose an agent for order #{oid}.")
+                pairs.append((oid, int(agent_raw), parse_drop_time(expected_raw)))
+        report = assign_deliveries(pairs)
+    except Exception as e:
+        rollback(e)
+        report = {"assigned": 0, "reassigned": 0, "unchanged": 0, "errors": [str(e)]}
 
-        db.session.commit()
-        flash("Delivery assigned/updated.", "ok")
+    if request.is_json:
+        return Response(json.dumps(report), status=400 if report["errors"] else 200, mimetype="application/json")
+    _assign_summary(report)
+    return redirect(request.referrer or url_for("admin_orders"))
+
+
+@app.route("/admin/orders/<int:oid>/assign", methods=["POST"])
+@role_required("Admin")
+def admin_assign_delivery(oid: int):
+    try:
+        report = assign_deliveries([(
+            oid, int(request.form["delivery_agent_id"]), parse_drop_time(request.form.get("expected_drop_at")),
+        )])
     except Exception as e:
-        db.session.rollback()
-        flash(str(e), "error")
+        rollback(e)
+        report = {"errors": [str(e)]}
+    if report["errors"]:
+        _assign_summary(report)
+    else:
+        flash("Delivery assigned/updated.", "ok")
     return redirect(url_for("admin_orders"))
 
 
+@app.route("/admin/perf")
+@role_required("Admin")
+def admin_perf():
+    rows = []
+    with perf_lock:
+        for endpoint, st in perf_stats.items():
+            totals = sorted(st.totals)
+            n = len(st.queries) or 1
+            rows.append({
+                "endpoint": endpoint,
+                "count": st.count,
+                "p50": percentile(totals, 50),
+                "p95": percentile(totals, 95),
+                "p99": percentile(totals, 99),
+                "queries": sum(st.queries) / n,
+                "sql_ms": sum(st.sql_ms) / n,
+                "render_ms": sum(st.render_ms) / n,
+                "n_plus_one": st.n_plus_one,
+                "buckets": list(st.buckets),
+            })
+    rows.sort(key=lambda r: -r["p95"])
+    bucket_labels = [f"<{b:g}ms" if b != float("inf") else ">2s" for b in PERF_BUCKETS_MS]
+    return render_template(
+        "admin/perf.html",
+        rows=rows,
+        bucket_labels=bucket_labels,
+        enabled=app.config["PROFILING"],
+    )
+
+
 # -------------------- RESTAURANT OWNER --------------------
 def owner_restaurants() -> list[Restaurant]:
     return Restaurant.query.filter_by(owner_id=g.user.user_id).order_by(Restaurant.restaurant_id.desc()).all()
@@ -870,7 +3454,7 @@ def owner_dashboard():
     orders = []
     if rest_ids:
         orders = Order.query.filter(Order.restaurant_id.in_(rest_ids)).order_by(Order.order_id.desc()).limit(20).all()
-    return render_template("owner/dashboard.html", rests=rests, orders=orders, calc_order_total=calc_order_total)
+    return render_template("owner/dashboard.html", rests=rests, orders=orders)
 
 
 @app.route("/owner/menu", methods=["GET", "POST"])
@@ -897,9 +3481,10 @@ def owner_menu():
             )
             db.session.add(mi)
             db.session.commit()
+            menu_cache.invalidate(active_rest.restaurant_id)
             flash("Menu item added.", "ok")
         except Exception as e:
-            db.session.rollback()
+            rollback(e)
             flash(str(e), "error")
         return redirect(url_for("owner_menu", rid=active_rest.restaurant_id))
 
@@ -921,9 +3506,10 @@ def owner_menu_update(mid: int):
         mi.category = request.form.get("category") or None
         mi.availability = True if request.form.get("availability") == "on" else False
         db.session.commit()
+        menu_cache.invalidate(r.restaurant_id)
         flash("Menu updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
 
     return redirect(url_for("owner_menu", rid=r.restaurant_id))
@@ -940,9 +3526,10 @@ def owner_menu_delete(mid: int):
     try:
         db.session.delete(mi)
         db.session.commit()
+        menu_cache.invalidate(r.restaurant_id)
         flash("Item deleted.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
 
     return redirect(url_for("owner_menu", rid=r.restaurant_id))
@@ -956,7 +3543,7 @@ def owner_orders():
     orders = []
     if rest_ids:
         orders = Order.query.filter(Order.restaurant_id.in_(rest_ids)).order_by(Order.order_id.desc()).limit(100).all()
-    return render_template("owner/orders.html", rests=rests, orders=orders, calc_order_total=calc_order_total)
+    return render_template("owner/orders.html", rests=rests, orders=orders)
 
 
 @app.route("/owner/orders/<int:oid>/status", methods=["POST"])
@@ -972,6 +3559,10 @@ def owner_update_order_status(oid: int):
     if new_status not in allowed:
         abort(400)
 
+    replay = idempotent_replay("owner-status")
+    if replay:
+        return redirect(replay)
+
     try:
         order.status = new_status
         if new_status == "Accepted":
@@ -980,21 +3571,257 @@ def owner_update_order_status(oid: int):
             order.preparing_at = now_utc()
 
         log_history(order.order_id, new_status, g.user.user_id, "Updated by restaurant owner")
+        emit_event(ORDER_EVENT_FOR_STATUS[new_status], order)
+        remember_idempotent_result(url_for("owner_orders"))
+        durations = stage_durations(order)
         db.session.commit()
+        observe_stages(durations)
         flash("Order status updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
 
     return redirect(url_for("owner_orders"))
 
 
+# -------------------- BULK MENU IMPORT --------------------
+# CSV (header row) or JSON (a list, or {"items": [...]}) with the columns
+#   menu_id, restaurant_id, name, price, category, availability
+# A row updates the item with its menu_id, else the item of that restaurant with
+# the same name (case-insensitive), else it inserts one. Omitted columns and
+# empty cells keep their current value (a JSON null clears the category).
+# Rows without restaurant_id go to the default restaurant.
+MENU_IMPORT_FIELDS = ("name", "price", "category", "availability")
+MENU_CATEGORY_NAMES = {"": None, **{c.lower(): c for c in MENU_CATEGORIES if c}}
+TRUTHY = {"1", "true", "yes", "y", "on"}
+FALSY = {"0", "false", "no", "n", "off"}
+
+
+def parse_menu_rows(data: bytes | str, filename: str = "") -> list[dict]:
+    text = data.decode("utf-8-sig") if isinstance(data, bytes) else data
+    stripped = text.lstrip()
+    if filename.lower().endswith(".json") or stripped.startswith(("[", "{")):
+        doc = json.loads(text)
+        rows = doc.get("items", []) if isinstance(doc, dict) else doc
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON must be a list of objects or {\"items\": [...]}.")
+        return rows
+    return list(csv.DictReader(io.StringIO(text), restval=""))
+
+
+def _clean_menu_row(raw: dict, default_rid: int | None) -> dict:
+    row = {k.strip().lower(): v for k, v in raw.items() if k}
+    out = {}
+    for key in ("menu_id", "restaurant_id"):
+        v = row.get(key)
+        if v not in (None, ""):
+            out[key] = int(v)
+    out.setdefault("restaurant_id", default_rid)
+    if out["restaurant_id"] is None:
+        raise ValueError("restaurant_id is required.")
+
+    if row.get("name") not in (None, ""):
+        out["name"] = str(row["name"]).strip()[:160]
+    if row.get("price") not in (None, ""):
+        price = Decimal(str(row["price"]).strip()).quantize(Decimal("0.01"))
+        if price < 0:
+            raise ValueError("price cannot be negative.")
+        out["price"] = price
+    if "category" in row and row["category"] != "":
+        category = (str(row["category"] or "")).strip()  # JSON null clears it
+        if category.lower() not in MENU_CATEGORY_NAMES:
+            raise ValueError(f"category must be Food, Drink or empty, not {category!r}.")
+        out["category"] = MENU_CATEGORY_NAMES[category.lower()]
+    if row.get("availability") not in (None, ""):
+        v = row["availability"]
+        flag = str(v).strip().lower() if not isinstance(v, bool) else ("1" if v else "0")
+        if flag not in TRUTHY | FALSY:
+            raise ValueError(f"availability must be yes/no, not {v!r}.")
+        out["availability"] = flag in TRUTHY
+    if "menu_id" not in out and "name" not in out:
+        raise ValueError("Each row needs a menu_id or a name.")
+    return out
+
+
+def import_menu(raw_rows: list[dict], default_rid: int | None = None,
+                allowed_rids: set[int] | None = None, dry_run: bool = False) -> dict:
+    """
+    Diffs `raw_rows` against the current menus (one SELECT) and, unless dry_run or a
+    row is invalid, applies every insert and update in one transaction with one
+    menu_cache bump per restaurant. Returns the change report.
+    """
+    report = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": [], "changes": [], "applied": False}
+    rows = []
+    for n, raw in enumerate(raw_rows, start=1):
+        try:
+            row = _clean_menu_row(raw, default_rid)
+            if allowed_rids is not None and row["restaurant_id"] not in allowed_rids:
+                raise ValueError(f"restaurant #{row['restaurant_id']} is not yours.")
+            rows.append((n, row))
+        except (ValueError, ArithmeticError) as e:
+            report["errors"].append(f"row {n}: {e}")
+
+    rids = {row["restaurant_id"] for _, row in rows}
+    current = db.session.execute(
+        db.select(MenuItem.menu_id, MenuItem.restaurant_id, MenuItem.name, MenuItem.price,
+                  MenuItem.category, MenuItem.availability)
+        .where(MenuItem.restaurant_id.in_(rids))
+    ).all() if rids else []
+    known_rids = set(db.session.execute(
+        db.select(Restaurant.restaurant_id).where(Restaurant.restaurant_id.in_(rids))
+    ).scalars()) if rids else set()
+
+    by_id = {m.menu_id: m for m in current}
+    by_name: dict[tuple[int, str], list] = {}
+    for m in current:
+        by_name.setdefault((m.restaurant_id, m.name.strip().lower()), []).append(m)
+
+    inserts, updates, update_rids, seen, touched = [], [], [], set(), set()
+    for n, row in rows:
+        rid = row["restaurant_id"]
+        if rid not in known_rids:
+            report["errors"].append(f"row {n}: restaurant #{rid} not found.")
+            continue
+        if "menu_id" in row:
+            cur = by_id.get(row["menu_id"])
+            if cur is None or cur.restaurant_id != rid:
+                report["errors"].append(f"row {n}: menu item #{row['menu_id']} not found in restaurant #{rid}.")
+                continue
+        else:
+            matches = by_name.get((rid, row["name"].lower()), [])
+            if len(matches) > 1:
+                report["errors"].append(f"row {n}: {len(matches)} items named {row['name']!r}; give a menu_id.")
+                continue
+            cur = matches[0] if matches else None
+
+        key = ("id", cur.menu_id) if cur else ("name", rid, row["name"].lower())
+        if key in seen:
+            report["errors"].append(f"row {n}: duplicate of an earlier row.")
+            continue
+        seen.add(key)
+
+        if cur is None:
+            if "price" not in row:
+                report["errors"].append(f"row {n}: new item {row['name']!r} needs a price.")
+                continue
+            item = {"restaurant_id": rid, "name": row["name"], "price": row["price"],
+                    "category": row.get("category"), "availability": row.get("availability", True)}
+            inserts.append(item)
+            touched.add(rid)
+            report["changes"].append({"op": "insert", "restaurant_id": rid, "name": row["name"]})
+            continue
+
+        diff = {}
+        for field in MENU_IMPORT_FIELDS:
+            if field not in row or (field == "name" and "menu_id" not in row):
+                continue  # a row matched by name does not rename
+            old, new = getattr(cur, field), row[field]
+            same = to_cents(old) == to_cents(new) if field == "price" else old == new
+            if not same:
+                diff[field] = new
+        if not diff:
+            report["unchanged"] += 1
+            continue
+        updates.append({"menu_id": cur.menu_id, **diff})
+        update_rids.append(rid)
+        touched.add(rid)
+        report["changes"].append({
+            "op": "update", "restaurant_id": rid, "menu_id": cur.menu_id, "name": cur.name,
+            "fields": {f: [str(getattr(cur, f)), str(v)] for f, v in diff.items()},
+        })
+
+    report["inserted"], report["updated"] = len(inserts), len(updates)
+    if report["errors"] or dry_run or not touched:
+        return report
+
+    # Bulk statements bypass the before_flush hook: one menu version per restaurant here
+    versions = {rid: next_menu_version(db.session.connection(), rid) for rid in touched}
+    for item in inserts:
+        item["version"] = versions[item["restaurant_id"]]
+    for item, rid in zip(updates, update_rids):
+        item["version"] = versions[rid]
+    if inserts:
+        db.session.execute(db.insert(MenuItem), inserts)
+    if updates:
+        db.session.execute(db.update(MenuItem), updates)  # executemany UPDATE ... WHERE menu_id = ?
+    db.session.commit()
+    for rid in touched:
+        menu_cache.invalidate(rid)
+    report["applied"] = True
+    return report
+
+
+@app.route("/owner/menu/import", methods=["POST"])
+@role_required("Restaurant Owner")
+def owner_menu_import():
+    """
+    Bulk import for the owner's restaurants: an uploaded file (form field "file"),
+    pasted text ("data") or a JSON body. ?dry_run=1 reports without applying.
+    JSON callers get the report as JSON; the form flashes a summary.
+    """
+    allowed = {r.restaurant_id for r in owner_restaurants()}
+    rid = request.values.get("rid", type=int)
+    if rid is not None and rid not in allowed:
+        abort(403)
+    dry_run = request.values.get("dry_run") in TRUTHY
+    wants_json = request.is_json or request.args.get("format") == "json"
+
+    try:
+        if request.is_json:
+            raw_rows = parse_menu_rows(request.get_data())
+        elif request.files.get("file"):
+            f = request.files["file"]
+            raw_rows = parse_menu_rows(f.read(), f.filename or "")
+        else:
+            raw_rows = parse_menu_rows(request.form.get("data") or "")
+        report = import_menu(raw_rows, rid, allowed, dry_run=dry_run)
+    except Exception as e:
+        rollback(e)
+        report = {"inserted": 0, "updated": 0, "unchanged": 0, "errors": [str(e)], "changes": [], "applied": False}
+
+    if wants_json:
+        return Response(json.dumps(report), status=400 if report["errors"] else 200, mimetype="application/json")
+
+    summary = f"{report['inserted']} new, {report['updated']} updated, {report['unchanged']} unchanged"
+    if report["errors"]:
+        flash(f"Nothing imported ({len(report['errors'])} problems): " + "; ".join(report["errors"][:5]), "error")
+    elif report["applied"]:
+        flash(f"Menu imported: {summary}.", "ok")
+    else:
+        flash(f"{'Dry run' if dry_run else 'No changes'}: {summary}.", "ok")
+    return redirect(url_for("owner_menu", rid=rid) if rid else url_for("owner_menu"))
+
+
+@app.cli.command("menu-import")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--restaurant", "rid", type=int, help="Restaurant for rows without restaurant_id.")
+@click.option("--dry-run", is_flag=True, help="Report changes without applying them.")
+def menu_import_command(path: str, rid: int | None, dry_run: bool) -> None:
+    """Bulk-imports a CSV/JSON menu file: flask --app app menu-import menu.csv --restaurant 3"""
+    with open(path, "rb") as f:
+        raw_rows = parse_menu_rows(f.read(), path)
+    started = time.perf_counter()
+    report = import_menu(raw_rows, rid, dry_run=dry_run)
+    elapsed = time.perf_counter() - started
+    for c in report["changes"][:50]:
+        click.echo(json.dumps(c))
+    if len(report["changes"]) > 50:
+        click.echo(f"... {len(report['changes']) - 50} more changes")
+    for err in report["errors"]:
+        click.echo(f"error: {err}", err=True)
+    state = "applied" if report["applied"] else ("dry run" if dry_run else "not applied")
+    click.echo(f"{report['inserted']} inserted, {report['updated']} updated, "
+               f"{report['unchanged']} unchanged ({state}, {elapsed:.2f}s)")
+    if report["errors"]:
+        raise SystemExit(1)
+
+
 # -------------------- DELIVERY AGENT --------------------
 @app.route("/agent")
 @role_required("Delivery Agent")
 def agent_dashboard():
     deliveries = DeliveryAssignment.query.filter_by(delivery_agent_id=g.user.user_id).order_by(DeliveryAssignment.delivery_id.desc()).limit(50).all()
-    return render_template("agent/dashboard.html", deliveries=deliveries, calc_order_total=calc_order_total)
+    return render_template("agent/dashboard.html", deliveries=deliveries)
 
 
 @app.route("/agent/order/<int:oid>")
@@ -1004,7 +3831,7 @@ def agent_order(oid: int):
     if not order.delivery or order.delivery.delivery_agent_id != g.user.user_id:
         abort(403)
 
-    total = calc_order_total(order)
+    total = order_total_cents(order)
     history = OrderStatusHistory.query.filter_by(order_id=order.order_id).order_by(OrderStatusHistory.created_at.asc()).all()
     last_loc = None
     if order.delivery.locations:
@@ -1021,13 +3848,22 @@ def agent_update_delivery(oid: int):
         abort(403)
 
     action = request.form["action"].strip()
+    if action not in ("pickup", "drop"):
+        abort(400)
+
+    replay = idempotent_replay("agent-delivery")
+    if replay:
+        return redirect(replay)
+
     try:
+        old_status = order.status
         if action == "pickup":
             order.delivery.status = "Pickup"
             order.delivery.pickup_at = now_utc()
             order.status = "Out for Delivery"
             order.out_for_delivery_at = now_utc()
             log_history(order.order_id, "Out for Delivery", g.user.user_id, "Picked up by agent")
+            emit_event("picked_up", order, delivery_id=order.delivery.delivery_id, agent_id=g.user.user_id)
 
         elif action == "drop":
             order.delivery.status = "Dropped"
@@ -1035,19 +3871,45 @@ def agent_update_delivery(oid: int):
             order.status = "Delivered"
             order.delivered_at = now_utc()
             log_history(order.order_id, "Delivered", g.user.user_id, "Delivered by agent")
+            emit_event("delivered", order, delivery_id=order.delivery.delivery_id, agent_id=g.user.user_id)
+            # Secondary work: thin out the ping trail once nobody is watching it live
+            enqueue("compact_locations", {"delivery_id": order.delivery.delivery_id}, delay=60)
 
-        else:
-            abort(400)
-
+        remember_idempotent_result(url_for("agent_order", oid=order.order_id))
+        durations = stage_durations(order)
+        rid, new_status = order.restaurant_id, order.status
         db.session.commit()
+        observe_stages(durations)
+        capacity.transition(rid, old_status, new_status)
+        if capacity.settle(rid):
+            db.session.commit()  # publishes the queued Active flip
         flash("Updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
 
     return redirect(url_for("agent_order", oid=order.order_id))
 
 
+@job("compact_locations")
+def compact_locations(payload: dict) -> None:
+    """Keeps LOCATION_KEEP evenly spaced pings (always the first and last) of a finished delivery."""
+    keep = app.config["LOCATION_KEEP"]
+    ids = db.session.execute(
+        db.select(DeliveryLocation.location_id)
+        .where(DeliveryLocation.delivery_id == payload["delivery_id"])
+        .order_by(DeliveryLocation.created_at, DeliveryLocation.location_id)
+    ).scalars().all()
+    if len(ids) <= keep:
+        return
+    step = (len(ids) - 1) / (keep - 1)
+    kept = {ids[round(i * step)] for i in range(keep)}
+    drop = [i for i in ids if i not in kept]
+    for k in range(0, len(drop), 1000):
+        db.session.execute(db.delete(DeliveryLocation).where(DeliveryLocation.location_id.in_(drop[k:k + 1000])))
+    db.session.commit()
+
+
 @app.route("/agent/delivery/<int:delivery_id>/location", methods=["POST"])
 @role_required("Delivery Agent")
 def agent_update_location(delivery_id: int):
@@ -1061,25 +3923,47 @@ def agent_update_location(delivery_id: int):
         note = (request.form.get("note") or "").strip() or None
 
         db.session.add(DeliveryLocation(delivery_id=d.delivery_id, lat=lat, lng=lng, note=note))
+        emit_event("location", d.order, delivery_id=d.delivery_id, lat=str(lat), lng=str(lng))
         db.session.commit()
         flash("Location updated.", "ok")
     except Exception as e:
-        db.session.rollback()
+        rollback(e)
         flash(str(e), "error")
 
     return redirect(url_for("agent_order", oid=d.order_id))
 
 
 # -------------------- INIT + RUN --------------------
+@job("backfill_tracking_codes")
+def backfill_tracking_codes(payload: dict) -> None:
+    # Add tracking_code to existing orders if missing (safe backfill)
+    for o in Order.query.filter((Order.tracking_code == None) | (Order.tracking_code == "")).all():  # noqa: E711
+        o.tracking_code = generate_tracking_code()
+    db.session.commit()
+
+
+@job("backfill_phone_keys")
+def backfill_phone_keys_job(payload: dict) -> None:
+    backfill_phone_keys()
+
+
+def init_db() -> None:
+    """
+    Creates tables and seeds demo data (needs an app context).
+    Startup backfills are queued as jobs so they never delay the first request.
+    """
+    db.create_all()
+    enqueue("backfill_tracking_codes")
+    enqueue("backfill_phone_keys")
+    db.session.commit()
+
+    seed_if_empty()
+
+
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
-        # Add tracking_code to existing orders if missing (safe backfill)
-        for o in Order.query.filter((Order.tracking_code == None) | (Order.tracking_code == "")).all():  # noqa: E711
-            o.tracking_code = generate_tracking_code()
-        db.session.commit()
-
-        seed_if_empty()
+        init_db()
         print("DB ready + seed ensured.")
+    start_job_runner()
 
     app.run(host="127.0.0.1", port=5000, debug=True, use_reloader=False)
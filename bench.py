@@ -0,0 +1,954 @@
+"""
+Benchmarks for the Food Aggregator app.
+
+    python bench.py money [--lines 200] [--repeat 2000]
+    python bench.py seed  --db sqlite:///bench.db --restaurants 500 --items 40 --agents 200 --orders 1000000
+    python bench.py load  --db sqlite:///bench.db [--iterations 200] [--concurrency 4]
+    python bench.py init  [--db sqlite://]
+    python bench.py idempotency [--threads 8]
+    python bench.py cart [--lines 1 5 25 100]
+    python bench.py ratelimit [--keys 10000] [--calls 200000] [--requests 2000]
+    python bench.py passwords [--method scrypt:32768:8:1] [--workers 4] [--logins 64]
+    python bench.py geo [--restaurants 100000] [--queries 2000] [--k 20] [--cell 2]
+
+`init` times creating and seeding a fresh database (in-memory SQLite by default).
+
+`idempotency` posts one idempotency_key from many threads at once to checkout,
+an owner status change and agent pickup/drop, and fails (exit 1) unless each
+writes exactly once and every duplicate gets the same redirect.
+
+`cart` reports the Cookie header sent with every request for a cart of N lines,
+stored in the session cookie (the old way) vs behind a cart id.
+
+`ratelimit` measures the token-bucket stores on their own and the cost they
+add to /track requests, next to the SQL lookups they save.
+
+`passwords` reports password checks (logins) per second, per core, on the
+request thread vs the process pool, and for cached repeat logins.
+
+`geo` compares the "near me" grid index with scanning every restaurant, and
+times the /restaurants?lat=&lng= route over the same catalog.
+
+`seed` bulk-loads synthetic data (restaurants, menus, agents, orders with
+status timelines, items, history, delivery assignments and location pings).
+`load` replays browse -> cart -> checkout -> track, owner status updates and
+agent location pings through the Flask test client, reports p50/p95/p99 and
+queries per request for each route, and compares against the previous run
+stored in bench_history.jsonl.
+"""
+from __future__ import annotations
+
+import argparse
+from datetime import timedelta
+from decimal import Decimal
+import json
+import os
+import random
+import threading
+import time
+import timeit
+
+
+def load_app(db_uri: str | None):
+    """Imports app.py against `db_uri` (app.py reads DATABASE_URL at import)."""
+    if db_uri:
+        os.environ["DATABASE_URL"] = db_uri
+    import app as fa
+    return fa
+
+
+def percentile(sorted_vals, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(p / 100 * len(sorted_vals)))]
+
+
+# -------------------- MONEY --------------------
+def _best_ns(fn, repeat: int, per: int) -> float:
+    return min(timeit.repeat(fn, number=repeat, repeat=5)) / (repeat * per) * 1e9
+
+
+def bench_money(args) -> None:
+    """
+    Per-line cost of the Decimal(str(x)) path vs integer cents, for:
+      cart   - prices already in cents (menu snapshot), line + total rendered
+      orders - Numeric(10,2) Decimals from order_items, summed per order
+    """
+    from app import to_cents, cents_str
+
+    rng = random.Random(42)
+    prices = [Decimal(f"{rng.randint(50, 2500)}.{rng.randint(0, 99):02d}") for _ in range(args.lines)]
+    qtys = [rng.randint(1, 5) for _ in range(args.lines)]
+    lines = list(zip(prices, qtys))
+    cent_lines = [(to_cents(p), q) for p, q in lines]
+
+    def cart_decimal():
+        total = Decimal("0.00")
+        for price, qty in lines:
+            line = Decimal(str(price)) * Decimal(str(qty))
+            f"{Decimal(str(line)):.2f}"
+            total += line
+        return f"{Decimal(str(total)):.2f}"
+
+    def cart_cents():
+        total = 0
+        for price, qty in cent_lines:
+            line = price * qty
+            cents_str(line)
+            total += line
+        return cents_str(total)
+
+    def orders_decimal():
+        total = Decimal("0.00")
+        for price, qty in lines:
+            total += Decimal(str(price)) * Decimal(str(qty))
+        return f"{Decimal(str(total)):.2f}"
+
+    def orders_cents():
+        return cents_str(sum(to_cents(price) * qty for price, qty in lines))
+
+    assert cart_decimal() == cart_cents()
+    assert orders_decimal() == orders_cents()
+
+    print(f"{args.lines} lines x {args.repeat} renders (ns/line)")
+    for name, old, new in (("cart", cart_decimal, cart_cents), ("orders", orders_decimal, orders_cents)):
+        d = _best_ns(old, args.repeat, args.lines)
+        c = _best_ns(new, args.repeat, args.lines)
+        print(f"  {name:<7} decimal {d:8.1f}   cents {c:8.1f}   speedup {d / c:5.2f}x")
+
+
+# -------------------- IDEMPOTENCY --------------------
+def bench_idempotency(args) -> None:
+    """
+    Fires the same idempotency_key from --threads clients at once, against a file
+    SQLite database, for checkout, an owner status change and agent pickup/drop.
+    Every duplicate must get the first request's redirect and exactly one change
+    (order, history row, event) may be written. Exits non-zero on any failure.
+    """
+    import sys
+    import tempfile
+
+    tmp = tempfile.TemporaryDirectory()
+    fa = load_app(args.db or f"sqlite:///{os.path.join(tmp.name, 'idempotency.db')}")
+    app, db = fa.app, fa.db
+    app.config.update(JOBS_AUTOSTART=False, PASSWORD_WORKERS=0, RATE_LIMIT_ENABLED=False)
+    with app.app_context():
+        fa.init_db()
+    failures = []
+
+    def client_as(email: str | None = None, password: str | None = None):
+        client = app.test_client()
+        if email:
+            client.post("/login", data={"email": email, "password": password})
+        return client
+
+    def fire(template, url: str, form: dict) -> list[tuple[int, str]]:
+        """POSTs `form` from --threads copies of `template`'s session, all released together."""
+        cookie = template.get_cookie("session").value
+        barrier = threading.Barrier(args.threads)
+        results = []
+
+        def worker():
+            client = app.test_client()
+            client.set_cookie("session", cookie)
+            barrier.wait()
+            resp = client.post(url, data=form)
+            results.append((resp.status_code, resp.headers.get("Location", "")))
+
+        threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def count(model, *where) -> int:
+        with app.app_context():
+            return db.session.execute(db.select(db.func.count()).select_from(model).where(*where)).scalar()
+
+    def check(name: str, results, writes: int, expect_in: str) -> None:
+        urls = {loc for _, loc in results}
+        ok = (all(status == 302 for status, _ in results) and len(urls) == 1
+              and expect_in in next(iter(urls)) and writes == 1)
+        print(f"  {name:<14} {'ok' if ok else 'FAILED':<7} {len(results)} requests -> {writes} write(s), "
+              f"redirects {sorted(urls)}")
+        if not ok:
+            failures.append(name)
+
+    print(f"{args.threads} concurrent duplicates per action")
+
+    # Checkout
+    with app.app_context():
+        item = fa.MenuItem.query.filter_by(restaurant_id=1, availability=True).first()
+    customer = client_as()
+    customer.post("/cart/add", data={"restaurant_id": item.restaurant_id, "menu_id": item.menu_id, "qty": 2})
+    before = count(fa.Order)
+    results = fire(customer, "/checkout", {
+        "customer_name": "Bench", "customer_phone": "0300-1234567", "customer_address": "Bench Street",
+        "idempotency_key": fa.new_idempotency_key(),
+    })
+    check("checkout", results, count(fa.Order) - before, "/track?tracking_code=")
+    with app.app_context():
+        oid = db.session.execute(db.select(db.func.max(fa.Order.order_id))).scalar()
+        owner_email = db.session.get(fa.Restaurant, item.restaurant_id).owner.email
+        agent_id, agent_email = db.session.execute(
+            db.select(fa.User.user_id, fa.User.email).where(fa.User.type == "Delivery Agent")).first()
+
+    # Owner status change
+    owner = client_as(owner_email, "owner123")
+    results = fire(owner, f"/owner/orders/{oid}/status",
+                   {"status": "Accepted", "idempotency_key": fa.new_idempotency_key()})
+    check("owner-status", results,
+          count(fa.OrderStatusHistory, fa.OrderStatusHistory.order_id == oid,
+                fa.OrderStatusHistory.status == "Accepted"), "/owner/orders")
+
+    # Agent pickup and drop
+    with app.app_context():
+        fa.assign_deliveries([(oid, agent_id, None)])
+    agent = client_as(agent_email, "agent123")
+    for action, event in (("pickup", "picked_up"), ("drop", "delivered")):
+        results = fire(agent, f"/agent/order/{oid}/update",
+                       {"action": action, "idempotency_key": fa.new_idempotency_key()})
+        check(f"agent-{action}", results,
+              count(fa.OrderEvent, fa.OrderEvent.order_id == oid, fa.OrderEvent.type == event),
+              f"/agent/order/{oid}")
+
+    tmp.cleanup()
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+
+
+# -------------------- CART COOKIE --------------------
+def bench_cart(args) -> None:
+    """
+    Cookie request-header bytes on a static asset request (every page load sends
+    it) with the cart stored in the signed session cookie, as before CartStore,
+    vs the cookie that now only carries a cart id.
+    """
+    fa = load_app("sqlite://")
+    app = fa.app
+    most = max(args.lines)
+    with app.app_context():
+        fa.init_db()
+        r = fa.Restaurant.query.filter_by(status="Active").first()
+        rid = r.restaurant_id
+        fa.db.session.add_all(fa.MenuItem(restaurant_id=rid, name=f"Bench Dish {i}", price=Decimal("199.00"),
+                                          category="Food", availability=True) for i in range(most))
+        fa.db.session.commit()
+        mids = [m.menu_id for m in fa.MenuItem.query.filter_by(restaurant_id=rid, availability=True)][:most]
+    serializer = app.session_interface.get_signing_serializer(app)
+
+    def cookie_bytes(client) -> int:
+        """Size of the Cookie header the client sends for /static/styles.css."""
+        cookie = client.get_cookie("session")
+        assert client.get("/static/styles.css").status_code == 200
+        return len(f"Cookie: session={cookie.value}") if cookie else 0
+
+    print("cart lines   cookie cart   cart id    (Cookie header bytes; browsers drop cookies over 4096)")
+    for n in args.lines:
+        client = app.test_client()
+        for mid in mids[:n]:
+            client.post("/cart/add", data={"restaurant_id": rid, "menu_id": mid, "qty": 3})
+        client.get("/cart")  # consumes the "Added to cart" flashes
+        by_id = cookie_bytes(client)
+        with app.app_context():  # the sql cart store reads through the session
+            cart = fa.cart_store.get(serializer.loads(client.get_cookie("session").value)["cart_id"])
+        assert len(cart["items"]) == n, cart
+        legacy = app.test_client()
+        legacy.set_cookie("session", serializer.dumps({"cart": cart}))
+        in_cookie = cookie_bytes(legacy)
+        print(f"  {n:>9}   {in_cookie:11}   {by_id:7}")
+
+
+# -------------------- RATE LIMITING --------------------
+def bench_ratelimit(args) -> None:
+    """
+      store - ns per take() for the in-memory and the mmap-shared buckets
+      track - /track latency with the limiter off and on, a 429 refusal, and an
+              unknown code answered from the not-found cache vs by SQL
+    """
+    import tempfile
+
+    fa = load_app("sqlite://")
+    keys = [f"track-ip:10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.keys)]
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = (("memory", fa.TokenBuckets(args.keys * 2)), ("shared", fa.SharedTokenBuckets(os.path.join(tmp, "b.bin"))))
+        print(f"take() over {args.keys} keys, {args.calls} calls (ns/call)")
+        for name, store in stores:
+            now = time.time()
+            started = time.perf_counter()
+            for i in range(args.calls):
+                store.take(keys[i % args.keys], 0.5, 20, now)
+            print(f"  {name:<7} {(time.perf_counter() - started) / args.calls * 1e9:8.0f}")
+
+    app = fa.app
+    with app.app_context():
+        fa.init_db()
+        item = fa.MenuItem.query.filter_by(availability=True).first()
+    client = app.test_client()
+    client.environ_base["REMOTE_ADDR"] = "10.0.0.1"
+    client.post("/cart/add", data={"restaurant_id": item.restaurant_id, "menu_id": item.menu_id, "qty": 1})
+    resp = client.post("/checkout", data={"customer_name": "Bench", "customer_phone": "0300-0000000",
+                                          "customer_address": "Bench Street"})
+    code = resp.headers.get("Location", "").partition("tracking_code=")[2]
+
+    def timed(url: str, n: int, before=None) -> tuple[float, int]:
+        """Best of 3 rounds of n requests (us/request) and the last status code."""
+        best, status = float("inf"), 0
+        for _ in range(3):
+            started = time.perf_counter()
+            for _ in range(n):
+                if before:
+                    before()
+                status = client.get(url).status_code
+            best = min(best, (time.perf_counter() - started) / n * 1e6)
+        return best, status
+
+    n = args.requests
+    unlimited = {k: (10 ** 9, 10 ** 9) for k in app.config["RATE_LIMITS"]}
+    limits = app.config["RATE_LIMITS"]
+    rows = []
+    if code:
+        app.config["RATE_LIMIT_ENABLED"] = False
+        timed(f"/track?tracking_code={code}", n)  # warm-up
+        rows.append(("found, limiter off", *timed(f"/track?tracking_code={code}", n)))
+        app.config.update(RATE_LIMIT_ENABLED=True, RATE_LIMITS=unlimited)
+        rows.append(("found, limiter on", *timed(f"/track?tracking_code={code}", n)))
+    app.config["RATE_LIMITS"] = unlimited
+    rows.append(("unknown, SQL", *timed("/track?tracking_code=ZZZZ000000", n, fa.unknown_tracking_codes._keys.clear)))
+    rows.append(("unknown, cached", *timed("/track?tracking_code=ZZZZ000000", n)))
+    app.config["RATE_LIMITS"] = {**limits, "track-ip": (1, 1)}
+    rows.append(("refused (429)", *timed("/track?tracking_code=ZZZZ000000", n)))
+    app.config["RATE_LIMITS"] = limits
+
+    print(f"/track, {n} requests each (us/request, in-memory SQLite)")
+    for name, us, status in rows:
+        print(f"  {name:<20} {us:8.1f}   [{status}]")
+
+
+# -------------------- PASSWORDS --------------------
+def bench_passwords(args) -> None:
+    from types import SimpleNamespace
+
+    fa = load_app("sqlite://")
+    cfg = fa.app.config
+    cfg.update(PASSWORD_METHOD=args.method, PASSWORD_CACHE_SECONDS=0)
+    cores = min(args.workers, os.cpu_count() or 1)
+
+    def run(n_threads: int) -> float:
+        users = [SimpleNamespace(user_id=i, password_hash=stored) for i in range(args.logins)]
+        chunks = [users[i::n_threads] for i in range(n_threads)]
+
+        def worker(chunk):
+            for u in chunk:
+                assert fa.passwords.verify(u, "agent123")
+
+        threads = [threading.Thread(target=worker, args=(c,)) for c in chunks]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return args.logins / (time.perf_counter() - started)
+
+    cfg["PASSWORD_WORKERS"] = 0
+    stored = fa.passwords.hash("agent123")
+    inline = run(1)
+
+    cfg["PASSWORD_WORKERS"] = args.workers
+    fa.passwords.hash("warm-up")  # starts the pool
+    pooled = run(args.workers * 2)
+    fa.passwords.shutdown()
+
+    cfg.update(PASSWORD_WORKERS=0, PASSWORD_CACHE_SECONDS=60)
+    user = SimpleNamespace(user_id=1, password_hash=stored)
+    fa.passwords.verify(user, "agent123")
+    n = 20_000
+    started = time.perf_counter()
+    for _ in range(n):
+        fa.passwords.verify(user, "agent123")
+    cached = n / (time.perf_counter() - started)
+
+    print(f"{args.method}, {args.logins} logins ({os.cpu_count()} CPUs)")
+    print(f"  request thread        {inline:10.1f} logins/s   {inline:10.1f} /core")
+    print(f"  pool x{args.workers:<3}             {pooled:10.1f} logins/s   {pooled / cores:10.1f} /core")
+    print(f"  cached repeat login   {cached:10.1f} logins/s")
+
+
+# -------------------- GEO --------------------
+CITIES = (  # (lat, lng, share of restaurants)
+    (24.8607, 67.0011, 0.35), (31.5204, 74.3587, 0.25), (33.6844, 73.0479, 0.15),
+    (34.0151, 71.5249, 0.10), (30.1798, 66.9750, 0.05), (25.3960, 68.3578, 0.10),
+)
+
+
+def city_point(rng, spread_km: float) -> tuple[float, float]:
+    lat, lng, _ = rng.choices(CITIES, weights=[c[2] for c in CITIES])[0]
+    return lat + rng.gauss(0, spread_km / 111.2), lng + rng.gauss(0, spread_km / 111.2)
+
+
+def bench_geo(args) -> None:
+    """
+      index - GeoIndex.nearest() vs a scan of every restaurant (same answers checked)
+      route - /restaurants?lat=&lng= over the same restaurants in SQLite, next to
+              the old full listing it replaces
+    """
+    import heapq
+
+    fa = load_app("sqlite://")
+    cfg = fa.app.config
+    rng = random.Random(args.seed)
+    points = [city_point(rng, args.spread) for _ in range(args.restaurants)]
+    rows = [(rid, lat, lng, f"Bench Kitchen {rid}") for rid, (lat, lng) in enumerate(points, 1)]
+    queries = [city_point(rng, args.spread) for _ in range(args.queries)]
+    k, radius = args.k, cfg["GEO_DELIVERY_RADIUS_KM"]
+
+    if args.cell:
+        cfg["GEO_CELL_KM"] = args.cell
+        fa.geo = fa.GeoIndex(args.cell)
+    cfg["GEO_RESYNC_SECONDS"] = float("inf")  # the rows loaded below are the whole catalog
+    index = fa.GeoIndex(cfg["GEO_CELL_KM"])
+    started = time.perf_counter()
+    index.load(rows)
+    built = time.perf_counter() - started
+
+    def scan(lat, lng):
+        hits = ((fa.distance_km(lat, lng, plat, plng), rid) for rid, plat, plng, _ in rows)
+        return heapq.nsmallest(k, (h for h in hits if h[0] <= radius))
+
+    def per_query(fn, qs) -> float:
+        started = time.perf_counter()
+        for lat, lng in qs:
+            fn(lat, lng)
+        return (time.perf_counter() - started) / len(qs) * 1e6
+
+    few = queries[:max(1, args.queries // 20)]  # the scan is slow: fewer queries
+    for lat, lng in few:
+        assert index.nearest(lat, lng, k, radius) == scan(lat, lng), (lat, lng)
+    indexed = per_query(lambda lat, lng: index.nearest(lat, lng, k, radius), queries)
+    scanned = per_query(scan, few)
+    found = sum(len(index.nearest(lat, lng, k, radius)) for lat, lng in queries) / len(queries)
+
+    print(f"{args.restaurants} restaurants around {len(CITIES)} cities, k={k}, radius {radius:g} km, "
+          f"{cfg['GEO_CELL_KM']:g} km cells")
+    print(f"  build index     {built * 1e3:10.1f} ms   ({len(index._cells)} cells)")
+    print(f"  nearest, index  {indexed:10.1f} us/query   ({found:.1f} found on average)")
+    print(f"  nearest, scan   {scanned:10.1f} us/query   speedup {scanned / indexed:6.1f}x")
+
+    app = fa.app
+    with app.app_context():
+        fa.init_db()
+        now = fa.now_utc()
+        first = (fa.db.session.execute(fa.db.select(fa.db.func.max(fa.Restaurant.restaurant_id))).scalar() or 0) + 1
+        _insert(fa, fa.Restaurant, [
+            dict(restaurant_id=first + i, name=f"Bench Kitchen {i}", address="Bench", status="Active",
+                 created_at=now, latitude=lat, longitude=lng)
+            for i, (lat, lng) in enumerate(points)
+        ])
+        fa.db.session.commit()
+        started = time.perf_counter()
+        fa.geo.resync(force=True)
+        loaded = time.perf_counter() - started
+
+    client = app.test_client()
+    n = args.requests
+    urls = [f"/restaurants?lat={lat:.6f}&lng={lng:.6f}" for lat, lng in queries[:n]]
+    client.get(urls[0])  # warm-up
+    started = time.perf_counter()
+    for url in urls:
+        assert client.get(url).status_code == 200
+    near_ms = (time.perf_counter() - started) / len(urls) * 1e3
+    started = time.perf_counter()
+    client.get("/restaurants")
+    all_ms = (time.perf_counter() - started) * 1e3
+
+    print(f"/restaurants in SQLite ({len(fa.geo)} open restaurants indexed in {loaded * 1e3:.0f} ms)")
+    print(f"  near me         {near_ms:10.2f} ms/request")
+    print(f"  full listing    {all_ms:10.2f} ms/request")
+
+
+# -------------------- SYNTHETIC DATA --------------------
+STATUS_WEIGHTS = (
+    ("Delivered", 80), ("Cancelled", 5), ("Out for Delivery", 4),
+    ("Preparing", 4), ("Accepted", 3), ("Placed", 4),
+)
+DISHES = (
+    ("Chicken Burger", "Food"), ("Zinger Wrap", "Food"), ("Chicken Biryani", "Food"), ("Fries", "Food"),
+    ("Chicken Karahi", "Food"), ("Seekh Kabab", "Food"), ("Nihari", "Food"), ("Haleem", "Food"),
+    ("Club Sandwich", "Food"), ("Pizza Slice", "Food"), ("Cold Drink", "Drink"), ("Lassi", "Drink"),
+    ("Chai", "Drink"), ("Mint Margarita", "Drink"),
+)
+CITY_CENTER = (24.8607, 67.0011)  # Karachi
+
+
+class Ids:
+    """Next free primary key per table, so related rows can be linked without flushes."""
+
+    def __init__(self, fa):
+        db = fa.db
+        self.next = {}
+        for model, col in ((fa.User, fa.User.user_id), (fa.Restaurant, fa.Restaurant.restaurant_id),
+                           (fa.MenuItem, fa.MenuItem.menu_id), (fa.Order, fa.Order.order_id),
+                           (fa.DeliveryAssignment, fa.DeliveryAssignment.delivery_id)):
+            self.next[model] = (db.session.execute(db.select(db.func.max(col))).scalar() or 0) + 1
+
+    def take(self, model) -> int:
+        i = self.next[model]
+        self.next[model] = i + 1
+        return i
+
+
+def _insert(fa, model, rows: list[dict]) -> None:
+    if rows:
+        fa.db.session.execute(fa.db.insert(model), rows)
+
+
+def seed_synthetic(fa, n_restaurants: int, n_items: int, n_agents: int, n_orders: int,
+                   pings: int = 8, chunk: int = 5000, seed: int = 42, quiet: bool = False) -> dict:
+    """Bulk-loads synthetic data through executemany inserts, committing every `chunk` orders."""
+    from werkzeug.security import generate_password_hash
+
+    db = fa.db
+    rng = random.Random(seed)
+    ids = Ids(fa)
+    now = fa.now_utc()
+    started = time.perf_counter()
+
+    # Hash once: every synthetic staff account shares a password per role.
+    owner_hash = generate_password_hash("owner123")
+    agent_hash = generate_password_hash("agent123")
+    tag = f"{seed}-{ids.next[fa.User]}"
+
+    owners, rest_rows, owner_rows = [], [], []
+    for i in range(n_restaurants):
+        uid = ids.take(fa.User)
+        owners.append(uid)
+        owner_rows.append(dict(
+            user_id=uid, full_name=f"Bench Owner {i}", email=f"bench-owner-{tag}-{i}@fa.local",
+            phone_number=f"b{tag}-o{i}"[:30], type="Restaurant Owner", password_hash=owner_hash,
+            address="Bench", created_at=now,
+        ))
+    _insert(fa, fa.User, owner_rows)
+
+    agents, agent_rows = [], []
+    for i in range(n_agents):
+        uid = ids.take(fa.User)
+        agents.append(uid)
+        agent_rows.append(dict(
+            user_id=uid, full_name=f"Bench Rider {i}", email=f"bench-agent-{tag}-{i}@fa.local",
+            phone_number=f"b{tag}-a{i}"[:30], type="Delivery Agent", password_hash=agent_hash,
+            address="Bench", created_at=now,
+        ))
+    _insert(fa, fa.User, agent_rows)
+
+    menus: dict[int, list[tuple[int, Decimal]]] = {}
+    item_rows = []
+    for i in range(n_restaurants):
+        rid = ids.take(fa.Restaurant)
+        rest_rows.append(dict(
+            restaurant_id=rid, owner_id=owners[i], name=f"Bench Kitchen {i}",
+            address=f"Block {i % 50}, Street {i}", status="Active", created_at=now,
+            latitude=CITY_CENTER[0] + rng.uniform(-0.15, 0.15), longitude=CITY_CENTER[1] + rng.uniform(-0.15, 0.15),
+        ))
+        menus[rid] = []
+        for j in range(n_items):
+            mid = ids.take(fa.MenuItem)
+            name, cat = DISHES[j % len(DISHES)]
+            price = Decimal(rng.randint(99, 1999))
+            menus[rid].append((mid, price))
+            item_rows.append(dict(
+                menu_id=mid, restaurant_id=rid, name=f"{name} {j // len(DISHES) + 1}" if j >= len(DISHES) else name,
+                price=price, category=cat, availability=rng.random() > 0.05, created_at=now,
+            ))
+    _insert(fa, fa.Restaurant, rest_rows)
+    for k in range(0, len(item_rows), chunk):
+        _insert(fa, fa.MenuItem, item_rows[k:k + chunk])
+    db.session.commit()
+
+    rest_ids = list(menus)
+    n_customers = max(1000, n_orders // 20)
+    statuses = [s for s, _ in STATUS_WEIGHTS]
+    weights = [w for _, w in STATUS_WEIGHTS]
+    totals = dict(orders=0, items=0, history=0, deliveries=0, locations=0)
+
+    done = 0
+    while done < n_orders:
+        batch = min(chunk, n_orders - done)
+        orders, items, history, deliveries, locations = [], [], [], [], []
+        for status in rng.choices(statuses, weights, k=batch):
+            oid = ids.take(fa.Order)
+            rid = rng.choice(rest_ids)
+            cust = rng.randrange(n_customers)
+            phone = f"0300-{cust:07d}"
+
+            in_flight = status in ("Placed", "Accepted", "Preparing", "Out for Delivery")
+            placed = now - (timedelta(minutes=rng.uniform(1, 90)) if in_flight
+                            else timedelta(days=rng.uniform(0.1, 90)))
+            t = {"placed_at": placed}
+            if status != "Placed":
+                t["accepted_at"] = placed + timedelta(minutes=rng.uniform(1, 8))
+            if status in ("Preparing", "Out for Delivery", "Delivered"):
+                t["preparing_at"] = t["accepted_at"] + timedelta(minutes=rng.uniform(2, 10))
+            if status in ("Out for Delivery", "Delivered"):
+                t["out_for_delivery_at"] = t["preparing_at"] + timedelta(minutes=rng.uniform(10, 30))
+            if status == "Delivered":
+                t["delivered_at"] = t["out_for_delivery_at"] + timedelta(minutes=rng.uniform(10, 40))
+            if status == "Cancelled":
+                t["cancelled_at"] = placed + timedelta(minutes=rng.uniform(1, 15))
+
+            row = dict(
+                order_id=oid, user_id=None, restaurant_id=rid, status=status,
+                payment_method="COD" if rng.random() < 0.7 else "Online",
+                tracking_code=f"S{oid:09d}", customer_name=f"Customer {cust}",
+                customer_phone=phone, customer_phone_key=fa.normalize_phone(phone),
+                customer_address=f"House {cust % 500}, Street {cust % 40}",
+                accepted_at=None, preparing_at=None, out_for_delivery_at=None,
+                delivered_at=None, cancelled_at=None,
+            )
+            row.update(t)
+            orders.append(row)
+            for mid, price in rng.sample(menus[rid], k=min(len(menus[rid]), rng.randint(1, 4))):
+                items.append(dict(order_id=oid, menu_item_id=mid, quantity=rng.randint(1, 3), price_at_purchase=price))
+            for st, col in (("Placed", "placed_at"), ("Accepted", "accepted_at"), ("Preparing", "preparing_at"),
+                            ("Out for Delivery", "out_for_delivery_at"), ("Delivered", "delivered_at"),
+                            ("Cancelled", "cancelled_at")):
+                if col in t:
+                    history.append(dict(order_id=oid, status=st, actor_user_id=None, note="synthetic", created_at=t[col]))
+
+            if status in ("Out for Delivery", "Delivered") or (status == "Preparing" and rng.random() < 0.5):
+                did = ids.take(fa.DeliveryAssignment)
+                pickup = t.get("out_for_delivery_at")
+                dropped = t.get("delivered_at")
+                deliveries.append(dict(
+                    delivery_id=did, order_id=oid, delivery_agent_id=rng.choice(agents),
+                    status="Dropped" if dropped else ("Pickup" if pickup else "Assigned"),
+                    assigned_at=t["preparing_at"], pickup_at=pickup, dropped_at=dropped,
+                    expected_drop_at=t["preparing_at"] + timedelta(minutes=45),
+                ))
+                if pickup:
+                    end = dropped or now
+                    lat, lng = CITY_CENTER[0] + rng.uniform(-0.1, 0.1), CITY_CENTER[1] + rng.uniform(-0.1, 0.1)
+                    for k in range(pings):
+                        lat += rng.uniform(-0.002, 0.002)
+                        lng += rng.uniform(-0.002, 0.002)
+                        locations.append(dict(
+                            delivery_id=did, lat=Decimal(f"{lat:.7f}"), lng=Decimal(f"{lng:.7f}"), note=None,
+                            created_at=pickup + (end - pickup) * (k + 1) / (pings + 1),
+                        ))
+
+        _insert(fa, fa.Order, orders)
+        _insert(fa, fa.OrderItem, items)
+        _insert(fa, fa.OrderStatusHistory, history)
+        _insert(fa, fa.DeliveryAssignment, deliveries)
+        _insert(fa, fa.DeliveryLocation, locations)
+        db.session.commit()
+
+        done += batch
+        for key, rows in (("orders", orders), ("items", items), ("history", history),
+                          ("deliveries", deliveries), ("locations", locations)):
+            totals[key] += len(rows)
+        if not quiet:
+            rate = done / (time.perf_counter() - started)
+            print(f"  {done:>10,} / {n_orders:,} orders  ({rate:,.0f} orders/s)", flush=True)
+
+    totals["seconds"] = round(time.perf_counter() - started, 2)
+    return totals
+
+
+def bench_seed(args) -> None:
+    fa = load_app(args.db)
+    with fa.app.app_context():
+        fa.init_db()
+        totals = seed_synthetic(fa, args.restaurants, args.items, args.agents, args.orders,
+                                pings=args.pings, chunk=args.chunk, seed=args.seed)
+    print(json.dumps(totals))
+
+
+def bench_init(args) -> None:
+    started = time.perf_counter()
+    fa = load_app(args.db)
+    imported = time.perf_counter()
+    with fa.app.app_context():
+        fa.init_db()
+        users = fa.User.query.count()
+    done = time.perf_counter()
+    print(f"import {imported - started:.3f}s  init_db {done - imported:.3f}s  ({users} users seeded)")
+
+
+# -------------------- LOAD SUITE --------------------
+class RouteRecorder:
+    """Per-thread endpoint name and query count for each test-client request."""
+
+    def __init__(self, fa):
+        from flask import request, request_started, request_finished
+        from sqlalchemy import event
+
+        self.local = threading.local()
+        self.samples: dict[str, list[tuple[float, int]]] = {}
+        self.lock = threading.Lock()
+
+        with fa.app.app_context():
+            engine = fa.db.engine
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _count(*_):
+            self.local.queries = getattr(self.local, "queries", 0) + 1
+
+        def _started(sender, **extra):
+            self.local.queries = 0
+
+        def _finished(sender, response, **extra):
+            self.local.endpoint = request.endpoint or "<unmatched>"
+            self.local.final_queries = self.local.queries
+
+        # Keep strong references: blinker holds receivers weakly.
+        self._receivers = (_count, _started, _finished)
+        request_started.connect(_started, fa.app)
+        request_finished.connect(_finished, fa.app)
+
+    def call(self, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        resp = fn(*args, **kwargs)
+        ms = (time.perf_counter() - t0) * 1000
+        with self.lock:
+            self.samples.setdefault(self.local.endpoint, []).append((ms, self.local.final_queries))
+        return resp
+
+
+def _login(client, rec, email: str, password: str) -> None:
+    rec.call(client.post, "/login", data={"email": email, "password": password})
+
+
+def customer_flow(fa, client, rec, rng, rest_ids) -> None:
+    rec.call(client.get, "/restaurants")
+    rid = rng.choice(rest_ids)
+    rec.call(client.get, f"/restaurant/{rid}")
+    with fa.app.app_context():
+        snap = fa.menu_snapshot(rid)
+    available = [m.menu_id for m in snap.items() if m.availability] if snap else []
+    if not available:
+        return
+    for mid in rng.sample(available, k=min(len(available), rng.randint(1, 3))):
+        rec.call(client.post, "/cart/add", data={"restaurant_id": rid, "menu_id": mid, "qty": rng.randint(1, 2)})
+    rec.call(client.get, "/cart")
+    phone = f"0300-{rng.randrange(10_000):07d}"
+    resp = rec.call(client.post, "/checkout", data={
+        "customer_name": "Load Test", "customer_phone": phone, "customer_address": "Bench Street",
+        "idempotency_key": fa.new_idempotency_key(),
+    })
+    loc = resp.headers.get("Location", "")
+    if "tracking_code=" in loc:
+        rec.call(client.get, loc)
+    rec.call(client.post, "/my-orders", data={"phone_number": phone})
+
+
+def owner_flow(fa, client, rec, rng, owner) -> None:
+    user_id, email = owner
+    _login(client, rec, email, "owner123")
+    rec.call(client.get, "/owner/orders")
+    with fa.app.app_context():
+        oid = fa.db.session.execute(
+            fa.db.select(fa.Order.order_id)
+            .join(fa.Restaurant, fa.Restaurant.restaurant_id == fa.Order.restaurant_id)
+            .where(fa.Restaurant.owner_id == user_id, fa.Order.status.in_(("Placed", "Accepted")))
+            .order_by(fa.Order.order_id.desc()).limit(1)
+        ).scalar()
+    if oid:
+        rec.call(client.post, f"/owner/orders/{oid}/status", data={
+            "status": rng.choice(("Accepted", "Preparing")), "idempotency_key": fa.new_idempotency_key(),
+        })
+    rec.call(client.get, "/logout")
+
+
+def agent_flow(fa, client, rec, rng, agent) -> None:
+    user_id, email = agent
+    _login(client, rec, email, "agent123")
+    rec.call(client.get, "/agent")
+    with fa.app.app_context():
+        row = fa.db.session.execute(
+            fa.db.select(fa.DeliveryAssignment.delivery_id, fa.DeliveryAssignment.order_id)
+            .where(fa.DeliveryAssignment.delivery_agent_id == user_id)
+            .order_by(fa.DeliveryAssignment.delivery_id.desc()).limit(1)
+        ).first()
+    if row:
+        for _ in range(3):
+            rec.call(client.post, f"/agent/delivery/{row.delivery_id}/location", data={
+                "lat": f"{24.86 + rng.uniform(-0.05, 0.05):.6f}", "lng": f"{67.0 + rng.uniform(-0.05, 0.05):.6f}",
+            })
+        rec.call(client.get, f"/agent/order/{row.order_id}")
+    rec.call(client.get, "/logout")
+
+
+def run_load(fa, iterations: int, concurrency: int, seed: int = 7) -> dict:
+    """Runs the scripted flows; returns {endpoint: {n, p50, p95, p99, queries}}."""
+    with fa.app.app_context():
+        db = fa.db
+        rest_ids = db.session.execute(
+            db.select(fa.Restaurant.restaurant_id).where(fa.Restaurant.status == "Active")
+        ).scalars().all()
+        owners = db.session.execute(
+            db.select(fa.User.user_id, fa.User.email).where(fa.User.type == "Restaurant Owner")
+        ).all()
+        agents = db.session.execute(
+            db.select(fa.User.user_id, fa.User.email).where(fa.User.type == "Delivery Agent")
+        ).all()
+
+    rec = RouteRecorder(fa)
+    per_thread = max(1, iterations // concurrency)
+
+    def worker(n: int):
+        rng = random.Random(seed + n)
+        for i in range(per_thread):
+            client = fa.app.test_client()
+            client.environ_base["REMOTE_ADDR"] = f"10.{n}.{i >> 8 & 255}.{i & 255}"  # one customer per address
+            customer_flow(fa, client, rec, rng, rest_ids)
+            if i % 4 == 0 and owners:
+                owner_flow(fa, fa.app.test_client(), rec, rng, rng.choice(owners))
+            if i % 2 == 0 and agents:
+                agent_flow(fa, fa.app.test_client(), rec, rng, rng.choice(agents))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    report = {}
+    for endpoint, samples in sorted(rec.samples.items()):
+        lat = sorted(ms for ms, _ in samples)
+        report[endpoint] = {
+            "n": len(samples),
+            "p50": round(percentile(lat, 50), 2),
+            "p95": round(percentile(lat, 95), 2),
+            "p99": round(percentile(lat, 99), 2),
+            "queries": round(sum(q for _, q in samples) / len(samples), 2),
+        }
+    report["_meta"] = {"seconds": round(elapsed, 2), "requests": sum(len(v) for v in rec.samples.values())}
+    return report
+
+
+def print_report(report: dict, previous: dict | None, tolerance: float) -> list[str]:
+    regressions = []
+    print(f"{'route':<28}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'q/req':>8}   vs previous p95")
+    for endpoint, r in report.items():
+        if endpoint.startswith("_"):
+            continue
+        prev = (previous or {}).get(endpoint)
+        delta = ""
+        if prev:
+            change = (r["p95"] - prev["p95"]) / prev["p95"] if prev["p95"] else 0.0
+            delta = f"{change:+.0%}"
+            if change > tolerance and r["p95"] - prev["p95"] > 1.0:
+                regressions.append(f"{endpoint}: p95 {prev['p95']}ms -> {r['p95']}ms")
+                delta += "  REGRESSION"
+            if r["queries"] > prev["queries"] + 0.5:
+                regressions.append(f"{endpoint}: queries/req {prev['queries']} -> {r['queries']}")
+                delta += "  +QUERIES"
+        print(f"{endpoint:<28}{r['n']:>7}{r['p50']:>9.2f}{r['p95']:>9.2f}{r['p99']:>9.2f}{r['queries']:>8.2f}   {delta}")
+    meta = report["_meta"]
+    print(f"{meta['requests']} requests in {meta['seconds']}s ({meta['requests'] / max(meta['seconds'], 1e-9):,.0f} req/s)")
+    return regressions
+
+
+def bench_load(args) -> None:
+    fa = load_app(args.db)
+    # Synthetic history leaves old orders in flight forever; don't let them fill the kitchens
+    fa.app.config["CAPACITY_DEFAULT_LIMIT"] = 0
+    with fa.app.app_context():
+        fa.init_db()
+        dialect = fa.db.engine.dialect.name
+
+    report = run_load(fa, args.iterations, args.concurrency)
+
+    previous = None
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["dialect"] == dialect:
+                    previous = entry["report"]
+
+    regressions = print_report(report, previous, args.tolerance)
+    with open(args.history, "a") as f:
+        f.write(json.dumps({"at": time.strftime("%Y-%m-%dT%H:%M:%S"), "dialect": dialect,
+                            "iterations": args.iterations, "concurrency": args.concurrency,
+                            "report": report}) + "\n")
+    if regressions:
+        print("Regressions vs previous run:")
+        for r in regressions:
+            print(f"  {r}")
+        raise SystemExit(1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("money", help="Decimal vs integer-cents totals")
+    p.add_argument("--lines", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=2000)
+    p.set_defaults(fn=bench_money)
+
+    p = sub.add_parser("seed", help="bulk-load synthetic data")
+    p.add_argument("--db", help="database URI (default: DATABASE_URL / app default)")
+    p.add_argument("--restaurants", type=int, default=200)
+    p.add_argument("--items", type=int, default=30, help="menu items per restaurant")
+    p.add_argument("--agents", type=int, default=100)
+    p.add_argument("--orders", type=int, default=100_000)
+    p.add_argument("--pings", type=int, default=8, help="location pings per picked-up delivery")
+    p.add_argument("--chunk", type=int, default=5000)
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(fn=bench_seed)
+
+    p = sub.add_parser("init", help="time a fresh create + seed")
+    p.add_argument("--db", default="sqlite://")
+    p.set_defaults(fn=bench_init)
+
+    p = sub.add_parser("idempotency", help="concurrent duplicate submits write once (exit 1 if not)")
+    p.add_argument("--db", help="database URI (default: a temporary SQLite file)")
+    p.add_argument("--threads", type=int, default=8)
+    p.set_defaults(fn=bench_idempotency)
+
+    p = sub.add_parser("cart", help="cookie bytes: cart in the session vs cart id only")
+    p.add_argument("--lines", type=int, nargs="+", default=[1, 5, 25, 100])
+    p.set_defaults(fn=bench_cart)
+
+    p = sub.add_parser("ratelimit", help="token-bucket and not-found cache overhead")
+    p.add_argument("--keys", type=int, default=10_000)
+    p.add_argument("--calls", type=int, default=200_000)
+    p.add_argument("--requests", type=int, default=2000)
+    p.set_defaults(fn=bench_ratelimit)
+
+    p = sub.add_parser("passwords", help="login hashing throughput per core")
+    p.add_argument("--method", default="scrypt:32768:8:1", help="Werkzeug hash method")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--logins", type=int, default=64)
+    p.set_defaults(fn=bench_passwords)
+
+    p = sub.add_parser("geo", help="nearest-restaurant index vs full scan")
+    p.add_argument("--restaurants", type=int, default=100_000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--k", type=int, default=20)
+    p.add_argument("--spread", type=float, default=15.0, help="km (std dev) around each city centre")
+    p.add_argument("--cell", type=float, help="GEO_CELL_KM override")
+    p.add_argument("--seed", type=int, default=42)
+    p.set_defaults(fn=bench_geo)
+
+    p = sub.add_parser("load", help="scripted load suite with per-route latency")
+    p.add_argument("--db", help="database URI (default: DATABASE_URL / app default)")
+    p.add_argument("--iterations", type=int, default=200, help="customer flows (owner/agent flows interleaved)")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--history", default="bench_history.jsonl")
+    p.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 growth before flagging")
+    p.set_defaults(fn=bench_load)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,11 @@ CREATE TABLE IF NOT EXISTS restaurants (
   address       VARCHAR(255) NOT NULL,
   status        ENUM('Active','Inactive','Busy') NOT NULL DEFAULT 'Active',
   created_at    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  max_in_flight INT NULL,                    -- kitchen limit; NULL = app default, 0 = unlimited
+  auto_busy     TINYINT(1) NOT NULL DEFAULT 0, -- Busy was set by the capacity tracker
+  menu_version  BIGINT NOT NULL DEFAULT 0,   -- bumped by every menu write (see menu_items.version)
+  latitude      DOUBLE NULL,                 -- WGS84; indexed in-process for "near me" (app.py GEO)
+  longitude     DOUBLE NULL,
   CONSTRAINT fk_rest_owner
     FOREIGN KEY (owner_id) REFERENCES users(user_id)
     ON DELETE SET NULL ON UPDATE CASCADE,
@@ -37,6 +42,13 @@ CREATE TABLE IF NOT EXISTS restaurants (
   INDEX idx_rest_name (name)
 ) ENGINE=InnoDB;
 
+-- Upgrade path for databases created before capacity tracking existed
+ALTER TABLE restaurants ADD COLUMN IF NOT EXISTS max_in_flight INT NULL AFTER created_at;
+ALTER TABLE restaurants ADD COLUMN IF NOT EXISTS auto_busy TINYINT(1) NOT NULL DEFAULT 0 AFTER max_in_flight;
+ALTER TABLE restaurants ADD COLUMN IF NOT EXISTS menu_version BIGINT NOT NULL DEFAULT 0 AFTER auto_busy;
+ALTER TABLE restaurants ADD COLUMN IF NOT EXISTS latitude DOUBLE NULL AFTER menu_version;
+ALTER TABLE restaurants ADD COLUMN IF NOT EXISTS longitude DOUBLE NULL AFTER latitude;
+
 -- =========================
 -- MENU ITEMS
 -- =========================
@@ -48,13 +60,28 @@ CREATE TABLE IF NOT EXISTS menu_items (
   category      ENUM('Food','Drink') NULL,
   availability  TINYINT(1) NOT NULL DEFAULT 1,
   created_at    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  version       BIGINT NOT NULL DEFAULT 0,   -- restaurants.menu_version of the last change
   CONSTRAINT fk_menu_restaurant
     FOREIGN KEY (restaurant_id) REFERENCES restaurants(restaurant_id)
     ON DELETE RESTRICT ON UPDATE CASCADE,
   INDEX idx_menu_restaurant (restaurant_id),
   INDEX idx_menu_avail (availability),
   INDEX idx_menu_cat (category),
-  INDEX idx_menu_name (name)
+  INDEX idx_menu_name (name),
+  INDEX idx_menu_items_version (restaurant_id, version)
+) ENGINE=InnoDB;
+
+-- Upgrade path for databases created before menu delta sync existed
+ALTER TABLE menu_items ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0 AFTER created_at;
+CREATE INDEX IF NOT EXISTS idx_menu_items_version ON menu_items (restaurant_id, version);
+
+-- Deleted menu items, so delta sync can tell clients to drop them
+CREATE TABLE IF NOT EXISTS menu_item_tombstones (
+  tombstone_id  INT AUTO_INCREMENT PRIMARY KEY,
+  restaurant_id INT NOT NULL,
+  menu_id       INT NOT NULL,
+  version       BIGINT NOT NULL,
+  INDEX idx_menu_tombstones_version (restaurant_id, version)
 ) ENGINE=InnoDB;
 
 -- =========================
@@ -82,6 +109,9 @@ CREATE TABLE IF NOT EXISTS orders (
   customer_name         VARCHAR(120) NULL,
   customer_phone        VARCHAR(30)  NULL,
   customer_address      VARCHAR(255) NULL,
+  customer_phone_key    VARCHAR(16)  NULL, -- normalized E.164-style phone for My Orders
+  customer_latitude     DOUBLE NULL, -- delivery point, when shared at checkout
+  customer_longitude    DOUBLE NULL,
 
   CONSTRAINT fk_orders_user
     FOREIGN KEY (user_id) REFERENCES users(user_id)
@@ -96,9 +126,17 @@ CREATE TABLE IF NOT EXISTS orders (
   INDEX idx_orders_status (status),
   INDEX idx_orders_tracking (tracking_code),
   INDEX idx_orders_phone (customer_phone),
+  INDEX idx_orders_phone_key (customer_phone_key, order_id DESC),
   INDEX idx_orders_placed (placed_at)
 ) ENGINE=InnoDB;
 
+-- Upgrade path for databases created before customer_phone_key existed
+-- (values are backfilled by app.py on startup)
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS customer_phone_key VARCHAR(16) NULL AFTER customer_address;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS customer_latitude DOUBLE NULL AFTER customer_phone_key;
+ALTER TABLE orders ADD COLUMN IF NOT EXISTS customer_longitude DOUBLE NULL AFTER customer_latitude;
+CREATE INDEX IF NOT EXISTS idx_orders_phone_key ON orders (customer_phone_key, order_id DESC);
+
 -- =========================
 -- ORDER ITEMS
 -- =========================
@@ -179,6 +217,67 @@ CREATE TABLE IF NOT EXISTS delivery_locations (
   INDEX idx_loc_created (created_at)
 ) ENGINE=InnoDB;
 
+-- =========================
+-- SERVER-SIDE CARTS (session cookie holds only cart_id)
+-- =========================
+CREATE TABLE IF NOT EXISTS carts (
+  cart_id       CHAR(32) PRIMARY KEY,
+  restaurant_id INT NULL,
+  updated_at    DATETIME NOT NULL,
+  INDEX idx_carts_updated (updated_at)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS cart_items (
+  cart_id      CHAR(32) NOT NULL,
+  menu_item_id INT NOT NULL,
+  quantity     INT NOT NULL,
+  PRIMARY KEY (cart_id, menu_item_id),
+  CONSTRAINT fk_cartitems_cart
+    FOREIGN KEY (cart_id) REFERENCES carts(cart_id)
+    ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- =========================
+-- IDEMPOTENCY KEYS (absorb double-submitted checkout / status forms)
+-- =========================
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  `key`      VARCHAR(64) PRIMARY KEY,
+  scope      VARCHAR(40) NOT NULL,
+  result_url VARCHAR(255) NULL,
+  created_at DATETIME NOT NULL,
+  INDEX idx_idem_created (created_at)
+) ENGINE=InnoDB;
+
+-- =========================
+-- BACKGROUND JOBS (persistent queue drained by app.py's JobRunner)
+-- =========================
+CREATE TABLE IF NOT EXISTS jobs (
+  job_id       INT AUTO_INCREMENT PRIMARY KEY,
+  kind         VARCHAR(60) NOT NULL,
+  payload      TEXT NOT NULL,
+  status       ENUM('queued','running','done','failed') NOT NULL DEFAULT 'queued',
+  attempts     INT NOT NULL DEFAULT 0,
+  max_attempts INT NOT NULL DEFAULT 5,
+  run_at       DATETIME NOT NULL,
+  locked_at    DATETIME NULL,
+  locked_by    VARCHAR(60) NULL,
+  last_error   VARCHAR(255) NULL,
+  created_at   DATETIME NOT NULL,
+  INDEX idx_jobs_due (status, run_at)
+) ENGINE=InnoDB;
+
+-- =========================
+-- ORDER EVENTS (transactional outbox read by /api/events consumers)
+-- =========================
+CREATE TABLE IF NOT EXISTS order_events (
+  event_id   BIGINT AUTO_INCREMENT PRIMARY KEY,
+  order_id   INT NOT NULL,
+  type       VARCHAR(30) NOT NULL,
+  payload    TEXT NOT NULL,
+  created_at DATETIME NOT NULL,
+  INDEX idx_events_created (created_at)
+) ENGINE=InnoDB;
+
 -- =========================
 -- ORDER TOTALS VIEW
 -- =========================
@@ -198,6 +297,8 @@ GROUP BY o.order_id;
 
 -- =========================
 -- TRIGGERS (remove customer-only restriction; keep agent validation)
+-- app.py enforces the same rule on every backend (SQLite has no SIGNAL),
+-- so this trigger is a second line of defence for writes from outside the app.
 -- =========================
 DELIMITER $$
 
@@ -19,3 +19,26 @@ document.querySelectorAll(".flash").forEach((flash) => {
     setTimeout(() => flash.remove(), 500);
   }, 4000);
 });
+
+// Offline support: cached pages and delta-synced menus (see /sw.js)
+if ("serviceWorker" in navigator) {
+  window.addEventListener("load", () => {
+    navigator.serviceWorker.register("/sw.js").catch(() => {});
+  });
+}
+
+// Location buttons: data-locate="<lat input>,<lng input>" fills those fields of the
+// button's form from the browser's position; data-locate-submit then submits it
+document.querySelectorAll("[data-locate]").forEach((btn) => {
+  btn.addEventListener("click", () => {
+    if (!navigator.geolocation) return;
+    const [latName, lngName] = btn.dataset.locate.split(",");
+    const form = btn.form;
+    navigator.geolocation.getCurrentPosition((pos) => {
+      form.elements[latName].value = pos.coords.latitude.toFixed(6);
+      form.elements[lngName].value = pos.coords.longitude.toFixed(6);
+      if ("locateSubmit" in btn.dataset) form.submit();
+      else btn.textContent = "Location added";
+    }, () => window.alert("Could not get your location."));
+  });
+});
@@ -1,13 +1,16 @@
-const STATIC_CACHE = "fa-static-v1";
-const API_CACHE = "fa-api-v1";
+const STATIC_CACHE = "fa-static-v2";
+const PAGE_CACHE = "fa-pages-v2";
 
 const STATIC_ASSETS = [
-  "/",
   "/static/styles.css",
   "/static/app.js",
   "/static/manifest.json"
 ];
 
+// Public pages that may be shown from cache when offline (staff pages never are)
+const OFFLINE_PAGES = ["/", "/restaurants"];
+const MENU_PAGE = /^\/restaurant\/(\d+)$/;
+
 self.addEventListener("install", (event) => {
   event.waitUntil(
     caches.open(STATIC_CACHE).then((cache) => cache.addAll(STATIC_ASSETS))
@@ -20,7 +23,7 @@ self.addEventListener("activate", (event) => {
     const keys = await caches.keys();
     await Promise.all(
       keys
-        .filter(k => ![STATIC_CACHE, API_CACHE].includes(k))
+        .filter(k => ![STATIC_CACHE, PAGE_CACHE].includes(k))
         .map(k => caches.delete(k))
     );
     await self.clients.claim();
@@ -32,36 +35,183 @@ self.addEventListener("fetch", (event) => {
   const url = new URL(req.url);
 
   if (url.origin !== self.location.origin) return;
+  if (req.method !== "GET") return;
+
+  // Live data: event feeds and the menu sync itself always go to the network
+  if (url.pathname.startsWith("/api/")) return;
 
-  if (req.method !== "GET") {
-    event.respondWith(fetch(req));
+  if (url.pathname.startsWith("/static/")) {
+    event.respondWith(staleWhileRevalidate(event, req));
     return;
   }
 
-  if (url.pathname.startsWith("/api/")) {
-    event.respondWith((async () => {
-      try {
-        const fresh = await fetch(req);
-        const cache = await caches.open(API_CACHE);
-        cache.put(req, fresh.clone());
-        return fresh;
-      } catch {
-        const cached = await caches.match(req);
-        return cached || new Response(JSON.stringify({ error: "Offline and no cached API data." }), {
-          status: 503,
-          headers: { "Content-Type": "application/json" }
-        });
-      }
-    })());
-    return;
+  if (req.mode === "navigate") {
+    const m = url.pathname.match(MENU_PAGE);
+    if (m) {
+      event.respondWith(menuPage(Number(m[1]), url));
+    } else if (OFFLINE_PAGES.includes(url.pathname)) {
+      event.respondWith(networkFirst(req));
+    }
   }
+});
 
-  event.respondWith((async () => {
-    const cached = await caches.match(req);
-    if (cached) return cached;
+async function staleWhileRevalidate(event, req) {
+  const cache = await caches.open(STATIC_CACHE);
+  const cached = await cache.match(req);
+  const fresh = fetch(req).then((res) => {
+    if (res.ok) cache.put(req, res.clone());
+    return res;
+  });
+  if (cached) {
+    event.waitUntil(fresh.catch(() => {}));
+    return cached;
+  }
+  return fresh;
+}
+
+async function networkFirst(req) {
+  const cache = await caches.open(PAGE_CACHE);
+  try {
     const fresh = await fetch(req);
-    const cache = await caches.open(STATIC_CACHE);
-    cache.put(req, fresh.clone());
+    if (fresh.ok && !fresh.redirected) cache.put(req, await withoutFlash(fresh.clone()));
     return fresh;
-  })());
-});
\ No newline at end of file
+  } catch {
+    return (await cache.match(req)) || offlineResponse();
+  }
+}
+
+// -------------------- Menu pages --------------------
+// The page chrome comes from the server as a small "shell" (X-Menu-Shell: 1) and
+// the item list is rendered here from an IndexedDB copy of the menu, which only
+// downloads the items changed since the version we already hold.
+
+async function menuPage(rid, url) {
+  const [shell, menu] = await Promise.all([menuShell(rid, url), syncMenu(rid).catch(() => null)]);
+  if (!shell) return offlineResponse();
+  if (shell.type === "opaqueredirect" || !shell.ok) return shell;
+
+  const html = await shell.text();
+  const list = menu ? renderItems(menu, url.searchParams) : '<p class="muted">Menu unavailable offline.</p>';
+  return new Response(html.replace("<!--menu-items-->", list), {
+    status: shell.status,
+    headers: rewrittenHeaders(shell)
+  });
+}
+
+async function menuShell(rid, url) {
+  const cache = await caches.open(PAGE_CACHE);
+  try {
+    const res = await fetch(url.href, {
+      headers: { "X-Menu-Shell": "1" },
+      credentials: "same-origin",
+      redirect: "manual"
+    });
+    if (res.ok) {
+      const stripped = await withoutFlash(res.clone());
+      await cache.put(url.href, stripped.clone());
+      await cache.put(url.pathname, stripped);
+    }
+    return res;
+  } catch {
+    return (await cache.match(url.href)) || (await cache.match(url.pathname));
+  }
+}
+
+async function syncMenu(rid) {
+  const db = await openMenus();
+  const menu = await idb(db.transaction("menus").objectStore("menus").get(rid));
+  let delta;
+  try {
+    const res = await fetch(`/api/menu/${rid}?since=${menu ? menu.version : 0}`, { credentials: "same-origin" });
+    if (!res.ok) return menu;
+    delta = await res.json();
+  } catch {
+    return menu;  // offline: show what we have
+  }
+
+  const items = new Map(delta.full || !menu ? [] : menu.items.map(m => [m.id, m]));
+  delta.deleted.forEach(id => items.delete(id));
+  delta.items.forEach(m => items.set(m.id, m));
+  const fresh = { rid, version: delta.version, restaurant: delta.restaurant, items: [...items.values()] };
+  await idb(db.transaction("menus", "readwrite").objectStore("menus").put(fresh));
+  return fresh;
+}
+
+function openMenus() {
+  const req = indexedDB.open("fa-menus", 1);
+  req.onupgradeneeded = () => req.result.createObjectStore("menus", { keyPath: "rid" });
+  return idb(req);
+}
+
+function idb(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+// Same filters and markup as templates/customer/restaurant_menu.html
+function renderItems(menu, params) {
+  const category = (params.get("category") || "").trim();
+  const onlyAvailable = (params.get("only_available") || "1") === "1";
+  const q = (params.get("q") || "").trim().toLowerCase();
+
+  let items = menu.items.slice().sort((a, b) => b.id - a.id);  // newest first
+  if (onlyAvailable) items = items.filter(m => m.available);
+  if (category === "Food" || category === "Drink") items = items.filter(m => m.category === category);
+  if (q) items = items.filter(m => m.name.toLowerCase().includes(q));
+
+  if (!items.length) return '<p class="muted">No menu items found for this filter.</p>';
+  return items.map(m => `
+      <div class="rowcard">
+        <div>
+          <div class="title">#${m.id} — ${esc(m.name)}</div>
+          <div class="meta">
+            ${esc(m.category || "—")} •
+            ${m.available ? '<span class="tag ok">Available</span>' : '<span class="tag warn">Unavailable</span>'}
+          </div>
+        </div>
+        <div class="row" style="justify-content:flex-end;gap:10px">
+          <div class="tag">PKR ${centsStr(m.price_cents)}</div>
+          ${m.available ? `
+            <form method="post" action="/cart/add">
+              <input type="hidden" name="restaurant_id" value="${menu.rid}">
+              <input type="hidden" name="menu_id" value="${m.id}">
+              <input class="qty" name="qty" type="number" min="1" value="1">
+              <button class="btn tiny primary" type="submit">Add</button>
+            </form>` : '<span class="pill warn">Not Available</span>'}
+        </div>
+      </div>`).join("");
+}
+
+function centsStr(cents) {
+  if (!cents) return "0.00";
+  const sign = cents < 0 ? "-" : "";
+  const abs = Math.abs(cents);
+  return `${sign}${Math.floor(abs / 100)}.${String(abs % 100).padStart(2, "0")}`;
+}
+
+function esc(s) {
+  return String(s).replace(/[&<>"']/g, c => ({ "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" }[c]));
+}
+
+// Flash messages belong to the response that consumed them, not to the cached copy
+async function withoutFlash(res) {
+  const html = (await res.text()).replace(/<!--flash-->[\s\S]*?<!--\/flash-->/, "");
+  return new Response(html, { status: res.status, headers: rewrittenHeaders(res) });
+}
+
+// The body has been decoded and edited, so its original length/encoding no longer apply
+function rewrittenHeaders(res) {
+  const headers = new Headers(res.headers);
+  headers.delete("Content-Length");
+  headers.delete("Content-Encoding");
+  return headers;
+}
+
+function offlineResponse() {
+  return new Response("<h1>Offline</h1><p>This page is not available offline.</p>", {
+    status: 503,
+    headers: { "Content-Type": "text/html; charset=utf-8" }
+  });
+}